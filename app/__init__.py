@@ -8,12 +8,20 @@ import keras.applications.resnet50
 from keras.models import Model
 import time
  
-from finder import initiate_engine, load
-from training import CountVectModel
+from engine_registry import EngineRegistry
+from engines_index import load_engines_index
+from cnn_feature_extraction import GALLERY_FEATURE_STORE
+from blender import Blender
+from training import load_text_model, load_w2vec_neighbours
+from detection_cache import get_detection_cache
 from search_engine import SearchEngine
 import parameters
  
 
+#bovw engines are queried with images, the web app searches gallery engines with CNN features of crops
+if parameters.FEATURE_MODEL == 'bovw':
+    raise ValueError("FEATURE_MODEL 'bovw' is not supported in web app, it is evaluated with main.py only")
+
 app = Flask(__name__)
 app.secret_key = os.urandom(12)
 app.config.from_object('config')
@@ -38,42 +46,58 @@ app.config['VOC_SOFA'] = './app/static/images/sofa/processed/vocabulary.yml'
 app.config['VOC_TABLE'] = './app/static/images/table/processed/vocabulary.yml'
 app.config['VOC_BED'] = './app/static/images/bed/processed/vocabulary.yml'
  
-app.config['ALLOWED_CLASSES'] = ['diningtable', 'chair', 'sofa', 'pottedplant', 'table', 'clock', 'bed']
+#gallery classes: images directory, static path of images and text query describing the class
+app.config['ENGINE_CLASSES'] = {
+    'clock': {'dir': app.config['CLOCK_DIR'], 'static': '/static/images/clock'},
+    'bed': {'dir': app.config['BED_DIR'], 'static': '/static/images/bed'},
+    'chair': {'dir': app.config['CHAIR_DIR'], 'static': '/static/images/chair'},
+    'plant_pot': {'dir': app.config['POT_DIR'], 'static': '/static/images/plant_pot', 'query': 'plant pot'},
+    'sofa': {'dir': app.config['SOFA_DIR'], 'static': '/static/images/sofa'},
+    'table': {'dir': app.config['TABLE_DIR'], 'static': '/static/images/table'},
+}
+#YOLO class names of gallery classes
+app.config['CLASS_ALIASES'] = {'diningtable': 'table', 'pottedplant': 'plant_pot'}
 
 app.config['CLASS_COLORS'] = {"chair": "#1a8cff", "pottedplant":"#ff9933", "sofa":"#ff0066", "clock":"#00ff99", "diningtable":"#66ffcc",
     "bed":"#00ff00", "room":"#000000"}
 
-app.config['OBJECT_FEATURES_FILE'] = 'pickles/object_features.pickle'
+app.config['OBJECT_FEATURES_FILE'] = parameters.OBJECT_FEATURES_CACHE
+app.config['PRODUCTS_DICT_FILE'] = 'pickles/products_dict.p'
+app.config['TEXT_MODEL_FILE'] = 'pickles/text_model.bin'
+app.config['WORD2VEC_FILE'] = 'pickles/word2vec_model.p'
+app.config['W2VEC_NEIGHBOURS_FILE'] = 'pickles/w2vec_neighbours.bin'
+app.config['ENGINES_INDEX_FILE'] = 'pickles/engines_' + parameters.FEATURE_MODEL + '.bin'
  
 
 # load dict
-with open('pickles/products_dict.p', 'rb') as handle:
+with open(app.config['PRODUCTS_DICT_FILE'], 'rb') as handle:
     products_dict = pickle.load(handle)
  
-# load w2vec model
-with open('pickles/word2vec_model.p', 'rb') as f:
-    model = pickle.load(f)
+# load precomputed w2vec neighbours, rebuilt only when w2vec model or products dict change
+w2vec_neighbours = load_w2vec_neighbours(
+    app.config['WORD2VEC_FILE'], app.config['PRODUCTS_DICT_FILE'], app.config['W2VEC_NEIGHBOURS_FILE'])
 
 
-# build search engine
-vectorizer = CountVectModel(products_dict)
-search_engine = SearchEngine(products_dict, vectorizer, model)
+# build search engine, text model is refitted only when products dict changes
+vectorizer = load_text_model(app.config['PRODUCTS_DICT_FILE'], app.config['TEXT_MODEL_FILE'])
+search_engine = SearchEngine(products_dict, vectorizer, w2vec_neighbours)
 
-#load yolo detections
-with open('pickles/bounding_boxes.pickle', 'rb') as f:
-    YOLO_detections = pickle.load(f)
-    print('Gallery yolo detections loaded!')
+#import gallery yolo detections into detections cache on first start
+detections_cache = get_detection_cache(parameters.DETECTIONS_DB)
+if len(detections_cache) == 0:
+    detections_cache.import_pickle('pickles/bounding_boxes.pickle', [app.config['ROOM_DIR'], app.config['UPLOAD_FOLDER']])
+print('Gallery yolo detections loaded!')
  
 model_extension = parameters.FEATURE_MODEL
 
 
-#load cnn features
-try:
-    with open('pickles/gallery_cnn_features_' + model_extension + '.pickle', 'rb') as f:
-        GALLERY_FEATURES = pickle.load(f)
-        print('Gallery CNN features loaded!')
-except FileNotFoundError:
-    print('No CNN features for model', model_extension)
+#open features cache of images and object crops, keyed by content hash
+GALLERY_FEATURE_STORE.load()
+
+#keep features of catalog product images in one matrix for blended results
+blender = Blender.from_feature_cache(
+    [os.path.join('app/static', product['img']) for product in products_dict.values() if product['img']],
+    app.config['OBJECT_FEATURES_FILE'])
 
 
 print('Model extension is', model_extension)
@@ -89,47 +113,11 @@ else:
     print('Wrong model in parameters')
  
 
-try:
-    with open('pickles/clock_' + model_extension + '.pickle', 'rb') as handle:
-        ENGINE_CLOCK = pickle.load(handle)
-        print(handle, 'loaded')
-except FileNotFoundError:
-    print ('No pickle file found')
-    ENGINE_CLOCK = initiate_engine(app.config['CLOCK_DIR'], model_extension, load(app.config['VOC_CLOCK']))
-try:
-    with open('pickles/bed_' + model_extension + '.pickle', 'rb') as handle:
-        ENGINE_BED = pickle.load(handle)
-        print(handle, 'loaded')
-except FileNotFoundError:
-    print ('No pickle file found')
-    ENGINE_BED = initiate_engine(app.config['BED_DIR'], model_extension, load(app.config['VOC_BED']))
-try:
-    with open('pickles/chair_' + model_extension + '.pickle', 'rb') as handle:
-        ENGINE_CHAIR = pickle.load(handle)
-        print(handle, 'loaded')
-except FileNotFoundError:
-    print ('No pickle file found')
-    ENGINE_CHAIR = initiate_engine(app.config['CHAIR_DIR'], model_extension, load(app.config['VOC_CHAIR']))
-try:
-    with open('pickles/plant_pot_' + model_extension + '.pickle', 'rb') as handle:
-        ENGINE_POT = pickle.load(handle)
-        print(handle, 'loaded')
-except FileNotFoundError:
-    print ('No pickle file found')
-    ENGINE_POT = initiate_engine(app.config['POT_DIR'], model_extension, load(app.config['VOC_CLOCK']))
-try:
-    with open('pickles/sofa_' + model_extension + '.pickle', 'rb') as handle:
-        ENGINE_SOFA = pickle.load(handle)
-        print(handle, 'loaded')
-except FileNotFoundError:
-    print ('No pickle file found')
-    ENGINE_SOFA = initiate_engine(app.config['SOFA_DIR'], model_extension, load(app.config['VOC_SOFA']))
-try:
-    with open('pickles/table_' + model_extension + '.pickle', 'rb') as handle:
-        ENGINE_TABLE = pickle.load(handle)
-        print(handle, 'loaded')
-except FileNotFoundError:
-    ENGINE_TABLE = initiate_engine(app.config['TABLE_DIR'], model_extension, load(app.config['VOC_TABLE']))
+#map per-class engines from one index file, rows of a class are read on its first query
+engines_index = load_engines_index(app.config['ENGINES_INDEX_FILE'], dict(
+    (class_name, config['dir']) for class_name, config in app.config['ENGINE_CLASSES'].items()), model_extension)
+#route detected classes and their aliases to engines, more classes can be registered at runtime
+engine_registry = EngineRegistry(engines_index, app.config['ENGINE_CLASSES'], app.config['CLASS_ALIASES'])
 
 print('All engines initiated')
  
@@ -3,68 +3,103 @@
 """
 
 import os
-from flask import Flask, render_template, request, flash, session
+from flask import Flask, render_template, request, flash, session, jsonify
 import numpy as np
 import pickle
 from PIL import Image
-from shutil import copy2
 from werkzeug.utils import secure_filename
 
-from app import app, search_engine, ENGINE_CHAIR, ENGINE_CLOCK, ENGINE_SOFA, ENGINE_BED, ENGINE_POT, ENGINE_TABLE
-from finder import return_similar
-from detect_objects import detect_class_onpic, crop_box_for_class, detect_objects_on_image, crop_bounding_box_from_image
-from cnn_feature_extraction import extract_features_cnn, save_image_features
+from app import app, search_engine, blender, engine_registry
+from finder import return_similar, return_similar_many
+from detect_objects import detect_class_onpic, detect_objects_on_image, crop_bounding_box_from_image, \
+    draw_detections, crop_object_for_class, crop_objects, save_crop_async
+from cnn_feature_extraction import GALLERY_FEATURE_STORE, save_image_features
+from engine_registry import UnknownClassError
+from image_hashes import crop_key, image_hash
 
 
 
-def get_engine(image_directory, allowed_classes):
+def get_engine(image_directory):
     bound_boxes = detect_objects_on_image(image_directory)
     predictions_path = os.path.join(
         app.config['YOLO_FOLDER'], 'predictions_' + os.path.basename(image_directory))
-    try:
-        copy2('predictions_' + os.path.basename(image_directory) +
-              '.png', predictions_path)
-        os.remove('predictions_' + os.path.basename(image_directory) + '.png')
-    except FileNotFoundError:
-        print('Nothing to copy - no yolo predictions image found')
-    object_class, _ = detect_class_onpic(bound_boxes, allowed_classes)
+    if bound_boxes != 0:
+        draw_detections(image_directory, bound_boxes, predictions_path)
+    else:
+        print('No yolo predictions for', image_directory)
+    object_class, _ = detect_class_onpic(bound_boxes, engine_registry.allowed_classes())
     print('Detected object class from bounding boxes', object_class)
-    search_dir, engine, static_path = get_directories(object_class)
+    if object_class not in engine_registry:
+        return None, None, None, object_class, bound_boxes
+    search_dir, engine, static_path = engine_registry.get(object_class)
+    print('Searching for results in ', search_dir)
     return search_dir, engine, static_path, object_class, bound_boxes
 
 
-def get_directories(object_class):
-    print('Getting directories for ', object_class)
-    if object_class == "chair":
-        search_dir = app.config['CHAIR_DIR']
-        engine = ENGINE_CHAIR
-        static_path = '/static/images/chair'
-    elif object_class == "clock":
-        search_dir = app.config['CLOCK_DIR']
-        engine = ENGINE_CLOCK
-        static_path = '/static/images/clock'
-    elif object_class == "pottedplant":
-        search_dir = app.config['POT_DIR']
-        engine = ENGINE_POT
-        static_path = '/static/images/plant_pot'
-    elif object_class == "sofa":
-        search_dir = app.config['SOFA_DIR']
-        engine = ENGINE_SOFA
-        static_path = '/static/images/sofa'
-    elif object_class in ("diningtable", "table"):
-        search_dir = app.config['TABLE_DIR']
-        engine = ENGINE_TABLE
-        static_path = '/static/images/table'
-    elif object_class == "bed":
-        search_dir = app.config['BED_DIR']
-        engine = ENGINE_BED
-        static_path = '/static/images/bed'
-    else:
-        search_dir = app.config['CLOCK_DIR']
-        engine = ENGINE_CLOCK
-        static_path = '/static/images/clock'
-    print('Searching for results in ', search_dir)
-    return search_dir, engine, static_path
+def class_text_query(object_class):
+    """Returns text query describing object class, class name itself for classes without engine"""
+    try:
+        return engine_registry.text_query(object_class)
+    except UnknownClassError:
+        return object_class
+
+
+def search_object(bound_boxes, image_directory, object_class, search_dir, engine):
+    """Returns (similar images, path of object image to show) for the most probable object of class.
+    The crop is searched in memory, its copy to show is written while the engine is queried"""
+    show_name = object_class + "_show_" + os.path.basename(image_directory)
+    object_crop = crop_object_for_class(bound_boxes, image_directory, object_class)
+    if object_crop is None:
+        # object too small, search the whole image
+        return return_similar(image_directory, search_dir, engine), os.path.join('/static/bounding_boxes', show_name)
+    box, cropped_image, cropped_image_show = object_crop
+    written = save_crop_async(cropped_image_show, os.path.join(app.config['BOUNDING_BOXES'], show_name))
+    similar_images = return_similar(
+        os.path.join(app.config['BOUNDING_BOXES'], object_class + "_" + os.path.basename(image_directory)),
+        search_dir, engine, image=cropped_image, image_key=crop_key(image_hash(image_directory), box))
+    written.result()
+    return similar_images, os.path.join('/static/bounding_boxes', show_name)
+
+
+def search_all_objects(image_directory):
+    """Returns predictions image path and results for every detected object that has a gallery engine.
+    Objects are cropped in memory from one decode of the image, their features are extracted in one batch
+    and engines of all objects are queried in parallel"""
+    bound_boxes = detect_objects_on_image(image_directory)
+    predictions_path = os.path.join(
+        app.config['YOLO_FOLDER'], 'predictions_' + os.path.basename(image_directory))
+    if bound_boxes == 0:
+        print('No yolo predictions for', image_directory)
+        return predictions_path, []
+    draw_detections(image_directory, bound_boxes, predictions_path)
+    crops = crop_objects(bound_boxes, image_directory, engine_registry.allowed_classes())
+    # crops to show are written while features are extracted and engines are queried
+    show_paths = ['%s_show_%d_%s' % (box[0], index, os.path.basename(image_directory))
+                  for index, (box, _, _) in enumerate(crops)]
+    written = [save_crop_async(cropped_image_show, os.path.join(app.config['BOUNDING_BOXES'], show_path))
+               for (_, _, cropped_image_show), show_path in zip(crops, show_paths)]
+    source_hash = image_hash(image_directory)
+    features = GALLERY_FEATURE_STORE.get_many([crop_key(source_hash, box) for box, _, _ in crops],
+                                              [cropped_image for _, cropped_image, _ in crops])
+    engines = [engine_registry.get(box[0]) for box, _, _ in crops]
+    similar = return_similar_many([(engine, object_features, search_dir, cropped_image)
+                                   for (search_dir, engine, _), object_features, (_, cropped_image, _)
+                                   in zip(engines, features, crops)])
+    objects = []
+    for (box, _, _), show_path, (_, _, static_path), similar_images in zip(crops, show_paths, engines, similar):
+        text_query = class_text_query(box[0])
+        objects.append({
+            'object_class': box[0],
+            'probability': box[1],
+            'box': [int(v) for v in box[2:6]],
+            'object_image': os.path.join('/static/bounding_boxes', show_path),
+            'result_images': [os.path.join(static_path, image) for image in similar_images],
+            'result_images_countvect': search_engine.process_query(text_query),
+            'result_images_w2vec': search_engine.process_query_w2vec(text_query),
+        })
+    for future in written:
+        future.result()
+    return predictions_path, objects
 
 
 def get_clicked_object(base_image_path, bound_boxes, image_x, image_y, width):
@@ -76,7 +111,7 @@ def get_clicked_object(base_image_path, bound_boxes, image_x, image_y, width):
     image_y = float(image_y) * rescale_factor
     print('Different image dimensions. Rescaling image by', rescale_factor)
     for box in bound_boxes:
-        if box[0] not in app.config['ALLOWED_CLASSES']:
+        if box[0] not in engine_registry:
             continue
         else:
             x1 = int(box[2])
@@ -92,19 +127,10 @@ def get_clicked_object(base_image_path, bound_boxes, image_x, image_y, width):
 
 
 def return_feature_blender_results(initial_image, w2vec_results, countvect_results):
-    initial_query = w2vec_results + countvect_results
-    print('initial query', initial_query)
-    # initial_image = './app' + visual_results[0]
+    print('initial query', w2vec_results + countvect_results)
     print('nitial_image', initial_image)
-    distances = {}
     initial_features = save_image_features(initial_image, app.config['OBJECT_FEATURES_FILE'])
-    for product_path in initial_query:
-        image_features = save_image_features(product_path, app.config['OBJECT_FEATURES_FILE'])
-        distances[product_path] = np.linalg.norm(
-            image_features - initial_features)
-    sorted_array = [key for key in sorted(
-        distances, key=distances.__getitem__)]
-    return sorted_array[:8]
+    return blender.rerank(initial_features, {'word2vec': w2vec_results, 'countvect': countvect_results}, n=8)
 
 
 @app.route('/')
@@ -181,34 +207,26 @@ def uploader_file():
         # cropped_image.save(os.path.join(
         #     app.config['UPLOAD_FOLDER'], crop_filename))
 
-        search_dir, engine, static_path, object_class, bound_boxes = get_engine(
-            image_directory, app.config['ALLOWED_CLASSES'])
+        search_dir, engine, static_path, object_class, bound_boxes = get_engine(image_directory)
         print('Object class is', object_class)
         predictions_path = os.path.join(
             app.config['YOLO_FOLDER'], 'predictions_' + os.path.basename(image_directory))
 
-        if object_class == "all":
+        if engine is None:
             object_image = image_directory
             object_image_path = os.path.join('static/uploads', image_filename)
             return render_template('furniture_not_found.html',
                                    query_image=os.path.join('/static/yolo_detections/', os.path.basename(predictions_path)))
         else:
-            object_image = crop_box_for_class(bound_boxes, image_directory, app.config[
-                                              'BOUNDING_BOXES'], object_class)
-            object_image_path = os.path.join(
-                '/static/bounding_boxes', object_class + "_show_" + os.path.basename(image_directory))
+            similar_images, object_image_path = search_object(
+                bound_boxes, image_directory, object_class, search_dir, engine)
             object_text = object_class
 
-        similar_images = return_similar(object_image, search_dir, engine)
         print('text query', query)
 
         if query == '':
-            if object_class == 'pottedplant':
-                images_countvect = search_engine.process_query('plant pot')
-                images_w2vec = search_engine.process_query_w2vec('plant pot')
-            else:
-                images_countvect = search_engine.process_query(object_class)
-                images_w2vec = search_engine.process_query_w2vec(object_class)
+            images_countvect = search_engine.process_query(class_text_query(object_class))
+            images_w2vec = search_engine.process_query_w2vec(class_text_query(object_class))
         else:
             images_countvect = search_engine.process_query(query)
             images_w2vec = search_engine.process_query_w2vec(query)
@@ -245,22 +263,16 @@ def gallery_uploader():
         query = request.form['query']
         image_directory = os.path.join(
             './app/static/images/room_scenes', os.path.basename(f))
-        search_dir, engine, static_path, object_class, bound_boxes = get_engine(
-            image_directory, app.config['ALLOWED_CLASSES'])
-        if object_class == "all":
-            object_image = image_directory
-            object_image_path = os.path.join(
-                'static/images/room_scenes', os.path.basename(image_directory))
-            object_text = "room"
-        else:
-            object_image = crop_box_for_class(bound_boxes, image_directory, app.config[
-                                              'BOUNDING_BOXES'], object_class)
-            object_image_path = os.path.join(
-                '/static/bounding_boxes', object_class + "_show_" + os.path.basename(image_directory))
-            object_text = object_class
+        search_dir, engine, static_path, object_class, bound_boxes = get_engine(image_directory)
         predictions_path = os.path.join(
             app.config['YOLO_FOLDER'], 'predictions_' + os.path.basename(image_directory))
-        similar_images = return_similar(object_image, search_dir, engine)
+        if engine is None:
+            # no furniture with a gallery engine on the scene
+            return render_template('furniture_not_found.html',
+                                   query_image=os.path.join('/static/yolo_detections/', os.path.basename(predictions_path)))
+        similar_images, object_image_path = search_object(
+            bound_boxes, image_directory, object_class, search_dir, engine)
+        object_text = object_class
         result_images = [os.path.join(static_path, image)
                          for image in similar_images]
         # if object_class == "all":
@@ -270,12 +282,8 @@ def gallery_uploader():
         #         app.config['YOLO_FOLDER'], os.path.basename(predictions_path))
 
         if query == '':
-            if object_class == 'pottedplant':
-                images_countvect = search_engine.process_query('plant pot')
-                images_w2vec = search_engine.process_query_w2vec('plant pot')
-            else:
-                images_countvect = search_engine.process_query(object_class)
-                images_w2vec = search_engine.process_query_w2vec(object_class)
+            images_countvect = search_engine.process_query(class_text_query(object_class))
+            images_w2vec = search_engine.process_query_w2vec(class_text_query(object_class))
         else:
             images_countvect = search_engine.process_query(query)
             images_w2vec = search_engine.process_query_w2vec(query)
@@ -314,12 +322,8 @@ def update_text():
         print('result images', result_images)
         print(type(result_images))
         if query == '':
-            if object_class == 'pottedplant':
-                images_countvect = search_engine.process_query('plant pot')
-                images_w2vec = search_engine.process_query_w2vec('plant pot')
-            else:
-                images_countvect = search_engine.process_query(object_class)
-                images_w2vec = search_engine.process_query_w2vec(object_class)
+            images_countvect = search_engine.process_query(class_text_query(object_class))
+            images_w2vec = search_engine.process_query_w2vec(class_text_query(object_class))
         else:
             images_countvect = search_engine.process_query(query)
             images_w2vec = search_engine.process_query_w2vec(query)
@@ -347,7 +351,7 @@ def update_text():
                                result_images_countvect=images_countvect,
                                result_blend=[y.replace("app/", "")
                                              for y in blended_results],
-                               object_color=app.config['CLASS_COLORS'][object_class])
+                               object_color=app.config['CLASS_COLORS'].get(object_class, '#000000'))
 
 
 @app.route('/update_object', methods=['GET', 'POST'])
@@ -383,10 +387,13 @@ def update_object():
             while os.path.isfile(cropped_image_path):
                 cropped_image_path = os.path.join(
                     app.config['BOUNDING_BOXES'], "2" + os.path.basename(cropped_image_path))
-            cropped_image.save(cropped_image_path)
-            search_dir, engine, static_path = get_directories(object_class)
+            # crop is searched in memory and written for rendering meanwhile
+            written = save_crop_async(cropped_image, cropped_image_path)
+            search_dir, engine, static_path = engine_registry.get(object_class)
             similar_images = return_similar(
-                cropped_image_path, search_dir, engine)
+                cropped_image_path, search_dir, engine, image=cropped_image,
+                image_key=crop_key(image_hash(base_image_path), clicked_box, with_margin=False))
+            written.result()
             result_images = [os.path.join(static_path, image)
                              for image in similar_images]
         else:
@@ -396,8 +403,8 @@ def update_object():
             click_is_valid = False
             result_images = [y.replace("'", "").replace("[", "").replace(
                 "]", "") for y in request.form['result_images'].split(',')]
-        images_countvect = search_engine.process_query(object_class)
-        images_w2vec = search_engine.process_query_w2vec(object_class)
+        images_countvect = search_engine.process_query(class_text_query(object_class))
+        images_w2vec = search_engine.process_query_w2vec(class_text_query(object_class))
         # result_images_w2vec = [os.path.join('/static', image) for image in images_w2vec]
         # result_images_countvect = [os.path.join('/static', image) for image in images_countvect]
         top4_blend = result_images[:4] + \
@@ -413,7 +420,53 @@ def update_object():
                                # text_query=text_query,
                                result_blend=top4_blend,
                                click_validation=click_is_valid,
-                               object_color=app.config['CLASS_COLORS'][object_class])
+                               object_color=app.config['CLASS_COLORS'].get(object_class, '#000000'))
+
+
+@app.route('/search_objects', methods=['POST'])
+def search_objects():
+    """Look for images similar to every object detected on uploaded or gallery image at once"""
+    if 'file' in request.files:
+        f = request.files['file']
+        image_directory = os.path.join(
+            app.config['UPLOAD_FOLDER'], secure_filename(f.filename))
+        f.save(image_directory)
+    else:
+        image_directory = os.path.join(
+            './app/static/images/room_scenes', os.path.basename(request.form['filename']))
+    predictions_path, objects = search_all_objects(image_directory)
+    return jsonify(query_image=os.path.join('/static/yolo_detections/', os.path.basename(predictions_path)),
+                   objects=objects)
+
+
+@app.route('/register_class', methods=['POST'])
+def register_class():
+    """Start building engine for gallery directory app/static/images/<class_name> and route class to it.
+    Features are extracted in background, progress is reported by /register_class/<class_name>"""
+    if not session.get('logged_in'):
+        return 'Not logged in', 403
+    class_name = secure_filename(request.form['class_name'])
+    directory = os.path.join('./app/static/images', class_name)
+    if not class_name or not os.path.isdir(directory):
+        return 'No gallery directory for class %s' % class_name, 400
+    aliases = [alias.strip() for alias in request.form.get('aliases', '').split(',') if alias.strip()]
+    if not engine_registry.register_async(class_name, directory, '/static/images/' + class_name, aliases,
+                                          request.form.get('query') or None):
+        return 'Another class is being registered, try again later', 409
+    return 'Registering engine for %s' % class_name, 202
+
+
+@app.route('/register_class/<class_name>')
+def register_class_status(class_name):
+    """Return JSON status of class registration"""
+    status, error = engine_registry.registration_status(secure_filename(class_name))
+    return jsonify(class_name=class_name, status=status, error=error), 404 if status == 'unknown' else 200
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Return hit counters of text query cache and image features store"""
+    return jsonify(text_queries=search_engine.stats(), image_features=GALLERY_FEATURE_STORE.stats())
 
 
 @app.route('/scene_gallery')
@@ -0,0 +1,85 @@
+"""Single-file storage for numpy arrays that can be memory-mapped
+
+An artifact file starts with a magic string and the length of a JSON header.
+The header keeps user metadata and, for every stored array, its dtype, shape
+and offset. Raw array blocks follow the header, aligned to ALIGNMENT bytes, so
+each of them can be opened with np.memmap without reading the whole file and
+pages are shared between processes that map the same artifact.
+
+"""
+
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'STYLEART'
+ALIGNMENT = 64
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Returns sha1 hex digest of file contents"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_artifact(path, arrays, metadata=None):
+    """Writes dict of numpy arrays and JSON-serializable metadata to path.
+    The file is written next to path and moved in place, so readers never see a partial artifact"""
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        if array.dtype.hasobject:
+            raise ValueError('Cannot store object array %s in artifact' % name)
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({'metadata': metadata or {}, 'arrays': layout}).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_artifact_header(path):
+    """Returns (metadata, arrays layout, data start offset) of artifact without touching array data"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not an artifact file' % path)
+        header_length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = _aligned(len(MAGIC) + 8 + header_length)
+    return header['metadata'], header['arrays'], data_start
+
+
+def open_array(path, layout, data_start, mode='r'):
+    """Memory-maps a single array described by its layout entry"""
+    shape = tuple(layout['shape'])
+    if 0 in shape:
+        return np.zeros(shape, dtype=layout['dtype'])
+    return np.memmap(path, dtype=layout['dtype'], mode=mode,
+                     offset=data_start + layout['offset'], shape=shape)
+
+
+def load_artifact(path, mode='r'):
+    """Returns (metadata, dict of memory-mapped arrays) stored in artifact file"""
+    metadata, layout, data_start = read_artifact_header(path)
+    arrays = {name: open_array(path, entry, data_start, mode) for name, entry in layout.items()}
+    return metadata, arrays
@@ -1,13 +1,107 @@
+import os
+import threading
+
 import numpy as np
 from sklearn.decomposition import TruncatedSVD
 
+import parameters
+from cnn_feature_extraction import save_images_features
+from feature_cache import get_feature_cache
+from image_hashes import image_hash_many
+
 
 class Blender(object):
+    """Blends visual and textual results. CNN features of catalog product images are kept
+    in one matrix keyed by image path, candidates are reranked with a single distance computation"""
+
+    def __init__(self, image_paths, features, weights=parameters.BLENDER_WEIGHTS,
+                 features_cache=parameters.OBJECT_FEATURES_CACHE):
+        self.image_paths = list(image_paths)
+        self.path_to_row = {path: row for row, path in enumerate(self.image_paths)}
+        self.features = np.asarray(features, dtype=np.float32)
+        self.weights = dict(weights)
+        self.features_cache = features_cache
+        self.svd = None
+        # guards features matrix, rows and SVD shared by request handlers
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_feature_cache(cls, image_paths, features_cache=parameters.OBJECT_FEATURES_CACHE, **kwargs):
+        """Creates blender from features already in features cache, other images are added on demand.
+        Content hashes of images are kept next to the cache, so only changed images are read at startup"""
+        blender = cls([], np.zeros((0, 0), dtype=np.float32), features_cache=features_cache, **kwargs)
+        cache = get_feature_cache(features_cache)
+        image_paths = [path for path in image_paths if os.path.isfile(path)]
+        hashes = image_hash_many(image_paths, features_cache + '.hashes.json')
+        known = [(path, cache.get(digest)) for path, digest in zip(image_paths, hashes)]
+        blender._append([(path, features) for path, features in known if features is not None])
+        print('Blender loaded features of %d product images' % len(blender.image_paths))
+        return blender
+
+    def _append(self, entries):
+        with self.lock:
+            # another thread may have added the same images meanwhile
+            entries = [(path, f) for path, f in dict(entries).items() if path not in self.path_to_row]
+            if not entries:
+                return
+            new_features = np.vstack([np.asarray(f, dtype=np.float32).ravel() for _, f in entries])
+            if len(self.image_paths) == 0:
+                self.features = new_features
+            else:
+                self.features = np.vstack([self.features, new_features])
+            for path, _ in entries:
+                self.path_to_row[path] = len(self.image_paths)
+                self.image_paths.append(path)
+            self.svd = None
+
+    def add_images(self, image_paths):
+        """Adds features of images not yet in the matrix, extracting them in one batch if needed"""
+        with self.lock:
+            missing = [path for path in dict.fromkeys(image_paths) if path not in self.path_to_row]
+        if missing:
+            features = save_images_features(missing, self.features_cache)
+            self._append([(path, f) for path, f in zip(missing, features) if f is not None])
+
+    def rerank(self, query_features, candidates, n=8):
+        """Returns n best image paths from candidates, a dict of result source name to ranked
+        list of image paths. Visual score is distance to query features scaled to [0, 1],
+        text sources score by reciprocal rank, scores are fused with configured weights"""
+        paths = list(dict.fromkeys(path for ranked in candidates.values() for path in ranked))
+        self.add_images(paths)
+        with self.lock:
+            paths = [path for path in paths if path in self.path_to_row]
+            if not paths:
+                return []
+            candidate_features = self.features[[self.path_to_row[path] for path in paths]]
+        query = np.asarray(query_features, dtype=np.float32).ravel()
+        distances = np.linalg.norm(candidate_features - query, axis=1)
+        max_distance = distances.max()
+        visual = 1.0 - distances / max_distance if max_distance > 0 else np.ones(len(paths))
+        scores = self.weights.get('visual', 0.0) * visual
+        for source, ranked in candidates.items():
+            weight = self.weights.get(source, 0.0)
+            if weight == 0.0:
+                continue
+            ranks = {path: rank for rank, path in reversed(list(enumerate(ranked)))}
+            scores = scores + weight * np.array([1.0 / (ranks[p] + 1) if p in ranks else 0.0 for p in paths])
+        # stable sort keeps candidates order between equal scores
+        order = np.argsort(-scores, kind='mergesort')[:n]
+        return [paths[i] for i in order]
+
+    def fit(self, n_components=25):
+        """Fits SVD reducer of image features once, refitted only after new images are added"""
+        self._fitted_svd(n_components)
+        return self
 
-	def __init__(self):
-		pass
+    def _fitted_svd(self, n_components=25):
+        """Returns (fitted SVD, features dimension), both read under the lock"""
+        with self.lock:
+            if self.svd is None:
+                self.svd = TruncatedSVD(n_components=n_components, n_iter=5, random_state=0)
+                self.svd.fit(self.features)
+            return self.svd, self.features.shape[1]
 
-	def transform_img_features(features_norm):
-    	svd = TruncatedSVD(n_components=25, n_iter=5)
-    	features_reduced = svd.fit_transform(features_norm)
-    	return features_reduced
\ No newline at end of file
+    def transform_img_features(self, features_norm):
+        """Returns image features reduced with SVD fitted on catalog features"""
+        svd, dim = self._fitted_svd()
+        return svd.transform(np.asarray(features_norm, dtype=np.float32).reshape(-1, dim))
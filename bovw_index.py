@@ -0,0 +1,241 @@
+"""Bag of visual words engine over SIFT descriptors
+
+CNN-free visual search: SIFT descriptors of an image are assigned to their
+nearest word of the category vocabulary (see create_visual_vocabulary.py),
+either with one vectorized distance computation per chunk of descriptors or
+with a KD-tree over the words. Images are TF-IDF weighted word histograms,
+stored as a words by images CSR matrix, so the row of a word is its postings
+list and a query scores only images sharing words with it.
+
+Indexes are written to artifact files (see artifacts.py) next to the other
+gallery pickles and rebuilt when the vocabulary changes.
+
+"""
+
+import argparse
+import os
+import threading
+
+import numpy as np
+import vse
+from PIL import Image
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+import parameters
+from artifacts import file_hash, load_artifact, save_artifact
+from create_visual_vocabulary import stream_descriptors
+from geom_check import create_extractor
+from processing_images import process_all_images
+
+QUANTIZERS = ('numpy', 'kdtree')
+BOVW_INDEX_VERSION = 1
+# number of descriptors assigned at once, bounds temporary distance matrix
+QUANTIZE_CHUNK = 4096
+# shorter side of images vse.convert_image accepts
+MIN_QUERY_SIZE = 150
+
+
+def vocabulary_path(directory):
+    """Returns path of vocabulary of gallery directory"""
+    return os.path.join(directory, 'processed', 'vocabulary.yml')
+
+
+def bovw_index_path(directory):
+    """Returns path of visual words index of gallery directory"""
+    return os.path.join('pickles', 'bovw_' + os.path.basename(os.path.normpath(directory)) + '.bin')
+
+
+def load_vocabulary(vocabulary_file):
+    """Returns float32 matrix of visual words saved by create_visual_vocabulary.py"""
+    return np.asarray(vse.load(vocabulary_file), dtype=np.float32)
+
+
+class Quantizer(object):
+    """Assigns descriptors to their nearest visual word"""
+
+    def __init__(self, vocabulary, mode=parameters.BOVW_QUANTIZER):
+        if mode not in QUANTIZERS:
+            raise ValueError('Unknown quantizer %s, use one of %s' % (mode, QUANTIZERS))
+        self.vocabulary = np.asarray(vocabulary, dtype=np.float32)
+        self.mode = mode
+        if mode == 'kdtree':
+            self.tree = cKDTree(self.vocabulary)
+        else:
+            self.sq_norms = (self.vocabulary ** 2).sum(axis=1)
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def words(self, descriptors):
+        """Returns word id of every descriptor row"""
+        descriptors = np.asarray(descriptors, dtype=np.float32).reshape(-1, self.vocabulary.shape[1])
+        if len(descriptors) == 0:
+            return np.zeros(0, dtype=np.int64)
+        if self.mode == 'kdtree':
+            return self.tree.query(descriptors, k=1)[1]
+        # squared norm of the descriptor is the same for all words and is left out
+        return np.concatenate([
+            np.argmin(self.sq_norms - 2.0 * descriptors[start:start + QUANTIZE_CHUNK].dot(self.vocabulary.T), axis=1)
+            for start in range(0, len(descriptors), QUANTIZE_CHUNK)])
+
+
+def word_counts(words):
+    """Returns (word ids, counts) of words of one image"""
+    return np.unique(np.asarray(words, dtype=np.int64), return_counts=True)
+
+
+class BOVWIndex(object):
+    """TF-IDF weighted visual word histograms of images with words to images inverted index"""
+
+    def __init__(self, ids, postings, idf):
+        self.ids = list(ids)
+        self.postings = postings
+        self.idf = np.asarray(idf, dtype=np.float32)
+
+    @classmethod
+    def from_counts(cls, ids, counts):
+        """Creates index from images by words CSR matrix of word counts"""
+        nb_images, nb_words = counts.shape
+        doc_freq = np.bincount(counts.indices, minlength=nb_words)
+        idf = np.zeros(nb_words, dtype=np.float32)
+        idf[doc_freq > 0] = np.log(nb_images / doc_freq[doc_freq > 0])
+        weights = csr_matrix(counts, dtype=np.float32)
+        weights.data *= idf[weights.indices]
+        norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        weights.data /= np.repeat(norms, np.diff(weights.indptr)).astype(np.float32)
+        return cls(ids, weights.T.tocsr(), idf)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def query_weights(self, words):
+        """Returns (word ids, normalized TF-IDF weights) of query words"""
+        terms, counts = word_counts(words)
+        weights = (counts * self.idf[terms]).astype(np.float32)
+        keep = weights > 0
+        terms, weights = terms[keep], weights[keep]
+        if len(weights):
+            weights /= np.sqrt((weights ** 2).sum())
+        return terms, weights
+
+    def find(self, words, n):
+        """Returns at most n (image_id, cosine similarity) of images sharing words with query, best first"""
+        terms, weights = self.query_weights(words)
+        if len(terms) == 0:
+            return []
+        # postings of query words only, images without shared words are never touched
+        postings = self.postings[terms]
+        rows = np.unique(postings.indices)
+        scores = np.asarray(postings.T.dot(weights)).ravel()[rows]
+        if n < len(rows):
+            best = np.argpartition(-scores, n - 1)[:n]
+            rows, scores = rows[best], scores[best]
+        order = np.argsort(-scores, kind='mergesort')
+        return [(self.ids[row], float(score)) for row, score in zip(rows[order], scores[order])]
+
+
+class VisualSearchEngine_bovw:
+
+    def __init__(self, index, quantizer):
+        self.index = index
+        self.quantizer = quantizer
+        self.extractor = create_extractor(parameters.CONTRAST_THRES, parameters.EDGE_THRES)
+
+    def image_words(self, image):
+        """Returns visual words of decoded PIL or grayscale numpy image, processed as gallery images are.
+        Images smaller than vse accepts, e.g. crops of small objects, are upscaled first"""
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        image = image.convert('L')
+        if min(image.size) < MIN_QUERY_SIZE:
+            scale = float(MIN_QUERY_SIZE) / min(image.size)
+            image = image.resize((max(MIN_QUERY_SIZE, int(round(image.size[0] * scale))),
+                                  max(MIN_QUERY_SIZE, int(round(image.size[1] * scale)))), Image.BICUBIC)
+        _, descriptors = self.extractor.detectAndCompute(vse.convert_image(np.asarray(image)), None)
+        return self.quantizer.words(descriptors if descriptors is not None else np.zeros((0, 128)))
+
+    def find_similar(self, image_path, n=1, image=None, key=None):
+        """Returns at most n similar images. Already decoded image is searched instead of reading
+        image_path when given, key is accepted for compatibility with CNN engines"""
+        return self.index.find(self.image_words(Image.open(image_path) if image is None else image), n)
+
+    def find_similar_features(self, words, n=1):
+        """Returns at most n images similar to already quantized visual words"""
+        return self.index.find(words, n)
+
+
+def build_bovw_index(directory, index_path=None, vocabulary_file=None, workers=parameters.VOCAB_WORKERS,
+                     quantizer_mode=parameters.BOVW_QUANTIZER):
+    """Quantizes descriptors of all images of gallery directory and writes their visual words index"""
+    index_path = index_path or bovw_index_path(directory)
+    vocabulary_file = vocabulary_file or vocabulary_path(directory)
+    quantizer = Quantizer(load_vocabulary(vocabulary_file), quantizer_mode)
+    processed_directory = process_all_images(directory)
+    filenames = sorted(f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))
+                       and os.path.exists(os.path.join(processed_directory, f)))
+    ids, indices, data, indptr = [], [], [], [0]
+    for filename, descriptors in stream_descriptors(processed_directory, filenames, workers, 0):
+        if descriptors is None:
+            continue
+        terms, counts = word_counts(quantizer.words(descriptors))
+        ids.append(filename)
+        indices.append(terms)
+        data.append(counts)
+        indptr.append(indptr[-1] + len(terms))
+    counts = csr_matrix((np.concatenate(data) if data else np.zeros(0), np.concatenate(indices) if indices
+                         else np.zeros(0, dtype=np.int64), indptr), shape=(len(ids), len(quantizer)))
+    index = BOVWIndex.from_counts(ids, counts)
+    save_artifact(index_path, {
+        'ids': np.array(ids, dtype=str), 'indptr': index.postings.indptr, 'indices': index.postings.indices,
+        'data': index.postings.data, 'idf': index.idf, 'vocabulary': quantizer.vocabulary},
+        {'version': BOVW_INDEX_VERSION, 'directory': directory, 'vocabulary_hash': file_hash(vocabulary_file)})
+    print('Visual words of %d images written to %s' % (len(ids), index_path))
+    return index_path
+
+
+def read_bovw_engine(index_path, quantizer_mode=parameters.BOVW_QUANTIZER):
+    """Returns engine over memory-mapped visual words index and its metadata"""
+    metadata, arrays = load_artifact(index_path)
+    vocabulary = np.asarray(arrays['vocabulary'])
+    postings = csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                          shape=(len(vocabulary), len(arrays['ids'])))
+    index = BOVWIndex(arrays['ids'].tolist(), postings, arrays['idf'])
+    return VisualSearchEngine_bovw(index, Quantizer(vocabulary, quantizer_mode)), metadata
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def load_bovw_engine(directory, vocabulary_file=None):
+    """Returns process-wide visual words engine of gallery directory. Index is built when missing
+    or made with another vocabulary"""
+    index_path = bovw_index_path(directory)
+    vocabulary_file = vocabulary_file or vocabulary_path(directory)
+    with _engines_lock:
+        if index_path not in _engines:
+            try:
+                engine, metadata = read_bovw_engine(index_path)
+                if metadata.get('version') != BOVW_INDEX_VERSION or \
+                        metadata.get('vocabulary_hash') != file_hash(vocabulary_file):
+                    raise ValueError('Visual words index %s is out of date' % index_path)
+            except (FileNotFoundError, ValueError):
+                print('No visual words index found in', index_path + ', building')
+                engine, _ = read_bovw_engine(build_bovw_index(directory, index_path, vocabulary_file))
+            _engines[index_path] = engine
+        return _engines[index_path]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'directories', nargs='+',
+        help="Gallery directories with vocabulary in processed/vocabulary.yml to be indexed")
+    parser.add_argument(
+        '--vocabulary',
+        help="Vocabulary file used instead of the one of every directory")
+    args = parser.parse_args()
+    for directory in args.directories:
+        build_bovw_index(directory, vocabulary_file=args.vocabulary)
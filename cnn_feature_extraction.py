@@ -2,14 +2,20 @@ import argparse
 import keras.applications.resnet50
 import numpy as np
 import os
-import pickle
+import threading
 import time
 import vse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
 
 from keras.preprocessing import image
 from keras.models import Model, load_model
 
-from detect_objects import crop_box_for_class, detect_class_onpic
+from dense_index import create_dense_index
+from feature_cache import get_feature_cache
+from detect_objects import crop_object_for_class, detect_class_onpic, detect_objects_on_image
+from image_hashes import crop_key, image_hash
 import parameters
 
 model_extension = parameters.FEATURE_MODEL
@@ -39,38 +45,143 @@ class VisualSearchEngine_cnn:
         features = extract_features_cnn(image_path)
         self.image_index[image_id] = features
 
+    def add_many_to_index_cnn(self, image_paths):
+        """Adds CNN features of many images, extracted in batches. Image ids are file names"""
+        for image_path, features in extract_features_cnn_batch(image_paths):
+            print('Adding %s to engine' % image_path)
+            self.image_index[os.path.basename(image_path)] = features
+
     def remove_from_index(self, image_id):
         """Removes item with image_id."""
         del self.image_index[image_id]
 
-    def find_similar(self, image_path, n=1):
-        """Returns at most n similar images."""
-        try:
-            with open("pickles/gallery_cnn_features_" + model_extension + ".pickle", "rb") as handle:
-                gallery_cnn_features = pickle.load(handle)
-                query_features = gallery_cnn_features[
-                    os.path.basename(image_path)]
-        except:
-            print('No features for this image found, extracting from CNN')
-            query_features = extract_features_cnn(image_path)
+    def find_similar(self, image_path, n=1, image=None, key=None):
+        """Returns at most n similar images. Features of already decoded image with content key
+        are looked up and extracted from it, image_path is not read then"""
+        query_features = GALLERY_FEATURE_STORE.get(image_path, image, key)
+        return self.image_index.find(query_features, n)
 
+    def find_similar_features(self, query_features, n=1):
+        """Returns at most n images similar to already extracted features."""
         return self.image_index.find(query_features, n)
 
 
-def create_vse(features_number=4096):
-    """Create visual search engine with default configuration."""
-    ranker = vse.SimpleRanker(hist_comparator=vse.Intersection())
-    inverted_index = vse.InvertedIndex(
-        ranker=ranker, recognized_visual_words=features_number)
-    return VisualSearchEngine_cnn(inverted_index)
+class FeatureStore:
+    """Process-wide CNN features lookup by image content. Features are kept in the on-disk
+    features cache shared by all processes, recently used ones also in a bounded LRU"""
 
+    def __init__(self, features_cache, max_recent=parameters.FEATURE_CACHE_SIZE):
+        self.features_cache = features_cache
+        self.max_recent = max_recent
+        self.recent = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
 
-def extract_features_cnn(img_path):
-    """Returns a normalized features vector for image path and model specified in parameters file """
-    print('Using model', parameters.FEATURE_MODEL)
+    def load(self):
+        """Opens features cache if it was not opened yet"""
+        return get_feature_cache(self.features_cache)
+
+    def _lookup(self, key):
+        with self.lock:
+            if key in self.recent:
+                self.hits += 1
+                self.recent.move_to_end(key)
+                return self.recent[key]
+        features = self.load().get(key)
+        with self.lock:
+            if features is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if features is not None:
+            self._remember(key, features)
+        return features
+
+    def _remember(self, key, features):
+        with self.lock:
+            self.recent[key] = features
+            self.recent.move_to_end(key)
+            while len(self.recent) > self.max_recent:
+                self.recent.popitem(last=False)
+
+    def get(self, image_path, image=None, key=None):
+        """Returns features for image, extracting them from CNN on a miss. Decoded image, e.g.
+        an in-memory crop, is used for extraction when given together with its content key,
+        otherwise image is read from image_path and keyed by hash of the file"""
+        if image is not None and key is None:
+            raise ValueError('Content key of decoded image %s is required' % image_path)
+        return self.get_many([key or image_hash(image_path)], [image if image is not None else image_path])[0]
+
+    def get_many(self, keys, images):
+        """Returns features for content keys, images missing in cache are extracted in one batch.
+        images are decoded PIL images or image paths"""
+        features = [self._lookup(key) for key in keys]
+        missing = {}
+        for key, img, image_features in zip(keys, images, features):
+            if image_features is None and key not in missing:
+                missing[key] = img
+        if missing:
+            print('No features for %d images found, extracting from CNN' % len(missing))
+            extracted = dict(zip(missing, extract_features_cnn_images(
+                [Image.open(img) if isinstance(img, str) else img for img in missing.values()])))
+            self.load().add_many(extracted.items())
+            for key, image_features in extracted.items():
+                self._remember(key, image_features)
+            features = [extracted[key] if image_features is None else image_features
+                        for key, image_features in zip(keys, features)]
+        return features
+
+    def add(self, key, features):
+        """Stores features of image with content key"""
+        self.load().add(key, features)
+        self._remember(key, features)
+
+    def stats(self):
+        """Returns lookup counters"""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'cache_size': len(self.load()), 'recent_size': len(self.recent)}
+
+
+GALLERY_FEATURE_STORE = FeatureStore(parameters.OBJECT_FEATURES_CACHE)
+
+
+def create_vse(index_mode=parameters.DENSE_INDEX, metric=parameters.DENSE_METRIC):
+    """Create visual search engine with dense index configured in parameters file."""
+    return VisualSearchEngine_cnn(create_dense_index(index_mode, metric))
+
+
+def load_image_array(img_path):
+    """Decodes image and resizes it to CNN input size"""
     img = image.load_img(img_path, target_size=(224, 224))
-    x = image.img_to_array(img)
-    x = np.expand_dims(x, axis=0)
+    return image.img_to_array(img)
+
+
+def image_to_array(img):
+    """Converts decoded PIL image to CNN input array, the same way keras load_img does"""
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return image.img_to_array(img.resize((224, 224), Image.NEAREST))
+
+
+def _load_image_or_none(img_path):
+    try:
+        return load_image_array(img_path)
+    except (OSError, ValueError):
+        print('Not an image', img_path)
+        return None
+
+
+def normalize_features(model_features):
+    """Returns float32 matrix of CNN outputs, each row divided by its sum"""
+    features = model_features.reshape(len(model_features), -1).astype(np.float32)
+    return features / features.sum(axis=1, keepdims=True)
+
+
+def predict_features(x):
+    """Returns normalized features for a stacked batch of image arrays"""
     if model_extension == "vgg19":
         x = keras.applications.vgg19.preprocess_input(x)
     elif model_extension == "vgg16":
@@ -79,51 +190,93 @@ def extract_features_cnn(img_path):
         x = keras.applications.resnet50.preprocess_input(x)
     else:
         print('Wrong model name')
-    model_features = model.predict(x, batch_size=1)
-    total_sum = sum(model_features[0])
-    features_norm = np.array(
-        [val / total_sum for val in model_features[0]], dtype=np.float32)
-    if parameters.FEATURE_MODEL == "resnet":
-        print("reshaping resnet")
-        features_norm = features_norm.reshape(2048)
-    return features_norm
-
-
-def save_image_features(img_path, features_file='pickles/gallery_cnn_features_' + model_extension + '.pickle'):
-    """Saves image features vector to pickle file """
-    try:
-        with open(features_file, 'rb') as handle:
-            features_set = pickle.load(handle)
-    except FileNotFoundError:
-        features_set = {}
-    image_name = os.path.basename(img_path)
-    if image_name in features_set:
-        print(image_name, 'features already in the file ! ')
-        return features_set[image_name]
-    else:
-        print('Extracting features for ', image_name)
-        query_features = extract_features_cnn(img_path)
-        features_set[image_name] = query_features
-        fileObject = open(features_file, 'wb')
-        pickle.dump(features_set, fileObject)
-        fileObject.close()
-        return query_features
-
-
-def save_features_for_objects(images_path, bounding_boxes_dir='./app/static/bounding_boxes',
-                              detections_file='pickles/bounding_boxes.pickle'):
-    """Detects objects , extracts features for objects and saves features to pickle file"""
+    model_features = model.predict(x, batch_size=len(x))
+    return normalize_features(model_features)
+
+
+def extract_features_cnn(img_path):
+    """Returns a normalized features vector for image path and model specified in parameters file """
+    print('Using model', parameters.FEATURE_MODEL)
+    x = np.expand_dims(load_image_array(img_path), axis=0)
+    return predict_features(x)[0]
+
+
+def extract_features_cnn_batch(img_paths, batch_size=parameters.CNN_BATCH_SIZE,
+                               workers=parameters.CNN_DECODE_WORKERS):
+    """Yields (image path, normalized features) for every readable image in img_paths.
+    Images are decoded in a pool of workers, next batch is decoded while the CNN runs on the current one"""
+    img_paths = list(img_paths)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = [pool.submit(_load_image_or_none, path) for path in img_paths[:batch_size]]
+        for start in range(0, len(img_paths), batch_size):
+            paths = img_paths[start:start + batch_size]
+            arrays = [future.result() for future in pending]
+            pending = [pool.submit(_load_image_or_none, path)
+                       for path in img_paths[start + batch_size:start + 2 * batch_size]]
+            loaded = [(path, array) for path, array in zip(paths, arrays) if array is not None]
+            if not loaded:
+                continue
+            print('Extracting features for batch of %d images' % len(loaded))
+            features = predict_features(np.stack([array for _, array in loaded]))
+            for (path, _), image_features in zip(loaded, features):
+                yield path, image_features
+
+
+def extract_features_cnn_images(images, batch_size=parameters.CNN_BATCH_SIZE):
+    """Returns normalized features matrix for already decoded PIL images, e.g. in-memory crops"""
+    features = [predict_features(np.stack([image_to_array(img) for img in images[start:start + batch_size]]))
+                for start in range(0, len(images), batch_size)]
+    return np.vstack(features) if features else np.zeros((0, 0), dtype=np.float32)
+
+
+def save_image_features(img_path, features_cache=parameters.OBJECT_FEATURES_CACHE):
+    """Returns image features vector, extracting and saving it to features cache if needed"""
+    return save_images_features([img_path], features_cache)[0]
+
+
+def save_images_features(img_paths, features_cache=parameters.OBJECT_FEATURES_CACHE):
+    """Returns features vectors for image paths. Features are looked up by image content hash,
+    missing ones are extracted in batches and appended to features cache at once"""
+    cache = get_feature_cache(features_cache)
+    keys = dict((img_path, image_hash(img_path)) for img_path in img_paths)
+    features = {}
+    for img_path, key in keys.items():
+        image_features = cache.get(key)
+        if image_features is not None:
+            features[img_path] = image_features
+    missing = [img_path for img_path in keys if img_path not in features]
+    # identical images under different paths are extracted once
+    missing = list(dict((keys[img_path], img_path) for img_path in missing).values())
+    if missing:
+        print('Extracting features for %d images' % len(missing))
+        extracted = list(extract_features_cnn_batch(missing))
+        cache.add_many((keys[img_path], image_features) for img_path, image_features in extracted)
+        features.update(extracted)
+    by_key = dict((keys[img_path], image_features) for img_path, image_features in features.items())
+    return [by_key.get(keys[img_path]) for img_path in img_paths]
+
+
+def save_features_for_objects(images_path, detections_file=parameters.DETECTIONS_DB):
+    """Detects objects, extracts features for the most probable object of every image and saves them to features cache"""
+    keys = []
+    object_images = []
     for image_name in os.listdir(images_path):
-        bound_boxes = detect_objects(os.path.join(images_path, image_name))
+        image_path = os.path.join(images_path, image_name)
+        bound_boxes = detect_objects_on_image(image_path, detections_file)
         if type(bound_boxes) == int:
             print(bound_boxes)
             print('BOUND BOXES NOT FOUND!')
+            continue
+        object_class, _ = detect_class_onpic(
+            bound_boxes, parameters.ALLOWED_CLASSES)
+        object_crop = crop_object_for_class(bound_boxes, image_path, object_class)
+        if object_crop is None:
+            keys.append(image_hash(image_path))
+            object_images.append(image_path)
         else:
-            object_class, _ = detect_class_onpic(
-                bound_boxes, parameters.ALLOWED_CLASSES)
-            object_image = crop_box_for_class(bound_boxes, os.path.join(
-                images_path, image_name), bounding_boxes_dir, object_class)
-            save_image_features(object_image)
+            keys.append(crop_key(image_hash(image_path), object_crop[0]))
+            object_images.append(object_crop[1])
+    GALLERY_FEATURE_STORE.get_many(keys, object_images)
 
 
 if __name__ == '__main__':
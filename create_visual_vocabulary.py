@@ -1,56 +1,173 @@
-"""Processes images from the selected directory and creates vocabulary of visual words"""
+"""Processes images from the selected directory and creates vocabulary of visual words
+
+SIFT descriptors are extracted in a process pool and streamed into mini-batch
+k-means, so only one batch of descriptors is held in memory whatever the size
+of the category. Images with many keypoints can be subsampled to a fixed
+number of descriptors. The clustering state is checkpointed next to the
+vocabulary and an interrupted run resumes from the last checkpoint.
+
+"""
 
 import argparse
+import hashlib
 import logging
 import os
+import pickle
 import time
-import cv2
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import vse
+from sklearn.cluster import MiniBatchKMeans
 
 import parameters  # model parameters defined in a separate file
-from processing_images import read_image, process_all_images
+from geom_check import create_extractor
+from processing_images import MANIFEST_FILE, read_image, process_all_images
 from finder import setup_logging, timeit
 
+VOCABULARY_FILE = 'vocabulary.yml'
+CHECKPOINT_FILE = 'vocabulary.ckpt'
+
+_extractor = None
+
+
+def _image_descriptors(args):
+    """Returns (filename, descriptors) of image, at most sample descriptors when sample is set"""
+    global _extractor
+    filename, directory, sample = args
+    if _extractor is None:
+        _extractor = create_extractor(parameters.CONTRAST_THRES, parameters.EDGE_THRES)
+    img = read_image(filename, directory)
+    if img is None:
+        return filename, None
+    _, des = _extractor.detectAndCompute(img, None)
+    if des is None:
+        return filename, None
+    if sample and len(des) > sample:
+        # seeded by file name, so a resumed run samples the same descriptors
+        rng = np.random.RandomState(zlib.crc32(filename.encode('utf-8')))
+        des = des[np.sort(rng.choice(len(des), sample, replace=False))]
+    return filename, np.asarray(des, dtype=np.float32)
+
+
+def stream_descriptors(directory, filenames, workers, sample):
+    """Yields (filename, descriptors) in file order, keeping a bounded number of images in flight"""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        filenames = iter(filenames)
+        for filename in filenames:
+            pending.append(pool.submit(_image_descriptors, (filename, directory, sample)))
+            if len(pending) >= 4 * workers:
+                break
+        while pending:
+            yield pending.popleft().result()
+            for filename in filenames:
+                pending.append(pool.submit(_image_descriptors, (filename, directory, sample)))
+                break
+
+
+def _source_files(directory):
+    """Returns sorted names of images in directory, files written by vocabulary creation and preprocessing left out"""
+    return sorted(f for f in os.listdir(directory)
+                  if os.path.isfile(os.path.join(directory, f)) and not f.endswith('.tmp')
+                  and f not in (VOCABULARY_FILE, CHECKPOINT_FILE, MANIFEST_FILE))
+
+
+def _load_checkpoint(checkpoint_path, settings):
+    """Returns saved clustering state or None when there is none or it was made with other settings"""
+    try:
+        with open(checkpoint_path, 'rb') as f:
+            state = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    saved = state.get('settings', {})
+    changed = sorted(name for name in settings if saved.get(name) != settings[name])
+    if changed:
+        print('Checkpoint', checkpoint_path, 'was made with different', ', '.join(changed) + ', starting over')
+        return None
+    return state
+
+
+def _save_checkpoint(checkpoint_path, state):
+    tmp_path = '%s.%d.tmp' % (checkpoint_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(tmp_path, checkpoint_path)
+
 
 @timeit
-def create_vocabulary(directory, features_clusters, extractor):
-    """Reads all images in the directory, extracts features.
+def create_vocabulary(directory, features_clusters, workers=parameters.VOCAB_WORKERS,
+                      sample=parameters.VOCAB_SAMPLE, batch_size=parameters.VOCAB_BATCH,
+                      checkpoint_every=parameters.VOCAB_CHECKPOINT_EVERY):
+    """Reads all images in the directory, extracts features and clusters them with mini-batch k-means.
        Returns vocabulary of n features"""
-    descriptors = []
-    for filename in os.listdir(directory):
-        img = read_image(filename, directory)
-        if img is not None:
-            _, des = extractor.detectAndCompute(img, None)
-            if des is not None:
-                logging.debug('%s has number of decriptors: %d' %
-                              (filename, len(des)))
-                descriptors.append(des)
-    # Initiate bag of words trainer
-    bow_kmeans_trainer = cv2.BOWKMeansTrainer(features_clusters)
-    for desc in descriptors:
-        bow_kmeans_trainer.add(desc)
-    logging.info("K-means clustering for features in progress ...")
-    vocabulary = bow_kmeans_trainer.cluster()
+    batch_size = max(batch_size, features_clusters)
+    checkpoint_path = os.path.join(directory, CHECKPOINT_FILE)
+    source_files = _source_files(directory)
+    settings = {'clusters': features_clusters, 'sample': sample, 'batch size': batch_size,
+                'images': hashlib.sha1('\n'.join(source_files).encode('utf-8')).hexdigest()}
+    state = _load_checkpoint(checkpoint_path, settings)
+    if state is None:
+        state = {'kmeans': MiniBatchKMeans(n_clusters=features_clusters, random_state=0, n_init=1),
+                 'done': set(), 'descriptors': 0, 'batches': 0, 'settings': settings}
+    else:
+        print('Resuming vocabulary from %s: %d images, %d descriptors clustered' %
+              (checkpoint_path, len(state['done']), state['descriptors']))
+    kmeans = state['kmeans']
+    filenames = [f for f in source_files if f not in state['done']]
+
+    buffered = []
+    buffered_files = []
+    nb_buffered = 0
+    for filename, des in stream_descriptors(directory, filenames, workers, sample):
+        buffered_files.append(filename)
+        if des is None or len(des) == 0:
+            continue
+        logging.debug('%s has number of decriptors: %d' % (filename, len(des)))
+        buffered.append(des)
+        nb_buffered += len(des)
+        if nb_buffered < batch_size:
+            continue
+        kmeans.partial_fit(np.vstack(buffered))
+        state['done'].update(buffered_files)
+        state['descriptors'] += nb_buffered
+        state['batches'] += 1
+        buffered, buffered_files, nb_buffered = [], [], 0
+        logging.info('Clustered %d descriptors of %d images' % (state['descriptors'], len(state['done'])))
+        if state['batches'] % checkpoint_every == 0:
+            _save_checkpoint(checkpoint_path, state)
+
+    if buffered:
+        if not hasattr(kmeans, 'cluster_centers_') and nb_buffered < features_clusters:
+            raise ValueError('%d descriptors found in %s, at least %d needed for vocabulary' %
+                             (nb_buffered, directory, features_clusters))
+        kmeans.partial_fit(np.vstack(buffered))
+        state['descriptors'] += nb_buffered
+    if not hasattr(kmeans, 'cluster_centers_'):
+        raise ValueError('No descriptors found in %s' % directory)
+    vocabulary = kmeans.cluster_centers_.astype(np.float32)
     # Save vocabulary data to file using pickle
-    ndir = os.path.join(directory, 'vocabulary.yml')
+    ndir = os.path.join(directory, VOCABULARY_FILE)
     vse.save(ndir, vocabulary)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    print('Vocabulary of %d words from %d descriptors written to %s' %
+          (features_clusters, state['descriptors'], ndir))
     return vocabulary
 
 
-def visual_vocabulary(voc_directory):
+def visual_vocabulary(voc_directory, workers=parameters.VOCAB_WORKERS, sample=parameters.VOCAB_SAMPLE):
     """Read all images, process them to new directory (black & white, resize)
         and create vocabulary"""
-    extractor = cv2.xfeatures2d.SIFT_create(
-        nfeatures=parameters.FEATURES_CLUSTERS,
-        contrastThreshold=parameters.CONTRAST_THRES,
-        edgeThreshold=parameters.EDGE_THRES)  # initialize feature extractor
-
     process_all_images(voc_directory)  # preprocess all images
     processed_directory = os.path.join(voc_directory, 'processed')
     create_vocabulary(
         processed_directory,
         parameters.FEATURES_CLUSTERS,
-        extractor)
+        workers=workers,
+        sample=sample)
     logging.info('Vocabulary was successfully created!')
 
 if __name__ == '__main__':
@@ -60,6 +177,12 @@ if __name__ == '__main__':
     parser.add_argument(
         'directory',
         help="Directory of images to be processed for vocabulary creation")
+    parser.add_argument(
+        '--workers', type=int, default=parameters.VOCAB_WORKERS,
+        help="Number of processes extracting descriptors")
+    parser.add_argument(
+        '--sample', type=int, default=parameters.VOCAB_SAMPLE,
+        help="Maximum number of descriptors used per image, 0 uses all")
     args = parser.parse_args()
     # Build visual vocabulary
-    visual_vocabulary(args.directory)
+    visual_vocabulary(args.directory, args.workers, args.sample)
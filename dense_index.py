@@ -0,0 +1,257 @@
+"""Dense vector indexes for CNN features
+
+Drop-in replacement for vse.InvertedIndex when the indexed vectors are dense
+CNN features. Indexes map image id to features vector and return
+(image_id, score) tuples from find, best match first, same as vse rankers.
+
+DenseIndex scores the query against every stored vector with one vectorized
+NumPy pass. IVFIndex clusters vectors with k-means and scores only vectors
+from the lists closest to the query.
+
+"""
+
+import argparse
+import pickle
+import time
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+import parameters
+
+METRICS = ('intersection', 'cosine', 'l2')
+# number of rows scored at once, bounds temporary memory of intersection
+SCORE_CHUNK = 4096
+
+
+class DenseIndex:
+    """Exact brute-force index over float32 matrix of features"""
+
+    def __init__(self, metric=parameters.DENSE_METRIC):
+        if metric not in METRICS:
+            raise ValueError('Unknown metric %s, use one of %s' % (metric, METRICS))
+        self.metric = metric
+        self.ids = []
+        self.id_to_row = {}
+        self.matrix = None
+        self.pending = []
+        self.norms = None
+
+    @classmethod
+    def from_matrix(cls, ids, matrix, **kwargs):
+        """Creates index over existing matrix without copying it, matrix may be np.memmap"""
+        index = cls(**kwargs)
+        index.ids = list(ids)
+        index.id_to_row = {image_id: row for row, image_id in enumerate(index.ids)}
+        index.matrix = matrix
+        index._build()
+        return index
+
+    def __setitem__(self, image_id, features):
+        if image_id in self.id_to_row:
+            raise KeyError('Image %s already exists in the index' % image_id)
+        self.id_to_row[image_id] = len(self.ids)
+        self.ids.append(image_id)
+        self.pending.append(np.asarray(features, dtype=np.float32).ravel())
+
+    def __delitem__(self, image_id):
+        row = self.id_to_row.pop(image_id)
+        self._compact()
+        self.matrix = np.delete(self.matrix, row, axis=0)
+        del self.ids[row]
+        self.id_to_row = {image_id: row for row, image_id in enumerate(self.ids)}
+        self._remove_row(row)
+
+    def __getitem__(self, image_id):
+        self._compact()
+        return self.matrix[self.id_to_row[image_id]]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _compact(self):
+        """Moves vectors added since last query into the matrix"""
+        if not self.pending:
+            return
+        new_rows = np.vstack(self.pending)
+        self.pending = []
+        if self.matrix is None or len(self.matrix) == 0:
+            start = 0
+            self.matrix = new_rows
+        else:
+            start = len(self.matrix)
+            self.matrix = np.vstack([self.matrix, new_rows])
+        self._add_rows(start)
+
+    def _build(self):
+        """Precomputes data used for scoring of the whole matrix"""
+        if self.metric in ('cosine', 'l2'):
+            self.norms = np.linalg.norm(self.matrix, axis=1)
+
+    def _add_rows(self, start):
+        """Updates data used for scoring after rows from start were appended to the matrix"""
+        if self.metric in ('cosine', 'l2'):
+            new_norms = np.linalg.norm(self.matrix[start:], axis=1)
+            self.norms = new_norms if start == 0 else np.concatenate([self.norms, new_norms])
+
+    def _remove_row(self, row):
+        """Updates data used for scoring after row was deleted from the matrix"""
+        if self.norms is not None:
+            self.norms = np.delete(self.norms, row)
+
+    def _score(self, query, rows):
+        """Returns similarity of query to matrix rows, higher is better"""
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        if self.metric == 'intersection':
+            scores = np.empty(len(matrix), dtype=np.float32)
+            for start in range(0, len(matrix), SCORE_CHUNK):
+                chunk = matrix[start:start + SCORE_CHUNK]
+                scores[start:start + SCORE_CHUNK] = np.minimum(chunk, query).sum(axis=1)
+            return scores
+        norms = self.norms if rows is None else self.norms[rows]
+        dots = matrix.dot(query)
+        if self.metric == 'cosine':
+            denominator = norms * np.linalg.norm(query)
+            denominator[denominator == 0] = 1.0
+            return dots / denominator
+        squared = norms ** 2 - 2 * dots + query.dot(query)
+        return -np.sqrt(np.maximum(squared, 0))
+
+    def _candidates(self, query):
+        """Returns row indices to be scored for query, None means all rows"""
+        return None
+
+    def find(self, query, n):
+        """Returns at most n (image_id, score) tuples, best first"""
+        self._compact()
+        if not self.ids:
+            return []
+        query = np.asarray(query, dtype=np.float32).ravel()
+        rows = self._candidates(query)
+        scores = self._score(query, rows)
+        n = min(n, len(scores))
+        if n == 0:
+            return []
+        best = np.argpartition(-scores, n - 1)[:n]
+        best = best[np.argsort(-scores[best])]
+        if rows is not None:
+            positions = rows[best]
+        else:
+            positions = best
+        if self.metric == 'l2':
+            # report distance, as vse Euclidean comparator does
+            return [(self.ids[p], float(-s)) for p, s in zip(positions, scores[best])]
+        return [(self.ids[p], float(s)) for p, s in zip(positions, scores[best])]
+
+
+class IVFIndex(DenseIndex):
+    """Approximate index: vectors are split into n_lists k-means clusters and
+    only n_probe clusters closest to the query are scored"""
+
+    def __init__(self, metric=parameters.DENSE_METRIC, n_lists=parameters.IVF_LISTS,
+                 n_probe=parameters.IVF_PROBES):
+        DenseIndex.__init__(self, metric)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.centroids = None
+        self.lists = None
+
+    def _build(self):
+        DenseIndex._build(self)
+        self.train()
+
+    def train(self):
+        """Refits k-means lists on all vectors. Vectors added or deleted later are assigned to,
+        or removed from, the existing lists; call train again once the data drifted"""
+        self._compact()
+        n_lists = min(self.n_lists, 0 if self.matrix is None else len(self.matrix))
+        if n_lists == 0:
+            self.centroids = None
+            self.lists = None
+            return
+        kmeans = KMeans(n_clusters=n_lists, n_init=1, random_state=0).fit(self.matrix)
+        self.centroids = kmeans.cluster_centers_.astype(np.float32)
+        assignments = kmeans.labels_
+        self.lists = [np.flatnonzero(assignments == i) for i in range(n_lists)]
+
+    def _assign(self, rows):
+        """Returns closest list of every vector"""
+        distances = (self.centroids ** 2).sum(axis=1) - 2 * np.asarray(rows, dtype=np.float32).dot(self.centroids.T)
+        return np.argmin(distances, axis=1)
+
+    def _add_rows(self, start):
+        DenseIndex._add_rows(self, start)
+        # lists are trained once the index has enough vectors for all of them
+        if self.centroids is None or len(self.centroids) < min(self.n_lists, len(self.matrix)):
+            self.train()
+            return
+        assignments = self._assign(self.matrix[start:])
+        for i in np.unique(assignments):
+            self.lists[i] = np.concatenate([self.lists[i], start + np.flatnonzero(assignments == i)])
+
+    def _remove_row(self, row):
+        DenseIndex._remove_row(self, row)
+        if self.lists is not None:
+            self.lists = [np.where(rows > row, rows - 1, rows)[rows != row] for rows in self.lists]
+
+    def _candidates(self, query):
+        if self.centroids is None or len(self.centroids) <= self.n_probe:
+            return None
+        distances = ((self.centroids - query) ** 2).sum(axis=1)
+        closest = np.argpartition(distances, self.n_probe - 1)[:self.n_probe]
+        return np.concatenate([self.lists[i] for i in closest])
+
+
+def create_dense_index(mode=parameters.DENSE_INDEX, metric=parameters.DENSE_METRIC):
+    """Returns empty dense index, mode in [exact, ivf]"""
+    if mode == 'exact':
+        return DenseIndex(metric=metric)
+    elif mode == 'ivf':
+        return IVFIndex(metric=metric)
+    raise ValueError('Unknown dense index mode %s' % mode)
+
+
+def index_vectors(index):
+    """Returns (ids, matrix) stored in vse.InvertedIndex or dense index"""
+    if isinstance(index, DenseIndex):
+        index._compact()
+        return list(index.ids), np.asarray(index.matrix)
+    vectors = {}
+    for subindex in index.index:
+        vectors.update(subindex)
+    ids = list(vectors)
+    return ids, np.vstack([np.asarray(vectors[i], dtype=np.float32).ravel() for i in ids])
+
+
+def benchmark(engine_files, n=parameters.NB_MATCHES, nb_queries=100):
+    """Compares recall and latency of the engines' current index with exact and IVF dense
+    indexes. Gallery vectors are used as queries, exact intersection ranking is the ground truth"""
+    for engine_file in engine_files:
+        with open(engine_file, 'rb') as handle:
+            engine = pickle.load(handle)
+        ids, matrix = index_vectors(engine.image_index)
+        queries = matrix[np.random.RandomState(0).permutation(len(matrix))[:nb_queries]]
+        truth = DenseIndex.from_matrix(ids, matrix, metric='intersection')
+        expected = [set(i for i, _ in truth.find(q, n)) for q in queries]
+        candidates = [('current', engine.image_index)]
+        for metric in METRICS:
+            candidates.append(('exact-' + metric, DenseIndex.from_matrix(ids, matrix, metric=metric)))
+            candidates.append(('ivf-' + metric, IVFIndex.from_matrix(ids, matrix, metric=metric)))
+        print('%s: %d images, %d queries, top %d' % (engine_file, len(ids), len(queries), n))
+        for name, index in candidates:
+            start = time.time()
+            found = [set(i for i, _ in index.find(q, n)) for q in queries]
+            latency = (time.time() - start) / len(queries)
+            recall = np.mean([len(f & e) / len(e) for f, e in zip(found, expected)])
+            print('    %-20s recall@%d %.3f    %.2f ms/query' % (name, n, recall, latency * 1000))
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'engines', nargs='+',
+        help="Pickled engines to benchmark, e.g. pickles/chair_resnet.pickle")
+    parser.add_argument('--queries', type=int, default=100)
+    args = parser.parse_args()
+    benchmark(args.engines, nb_queries=args.queries)
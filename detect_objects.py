@@ -1,18 +1,20 @@
 import argparse
 import ctypes
 import os
-import pickle
-from PIL import Image
-from shutil import copy2
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw
 
 import parameters
+from detection_cache import get_detection_cache
+from image_hashes import image_hash
 
 mylib = ctypes.cdll.LoadLibrary('./libdarknetlnx.so')
 
 # relevant structures from C
 class image (ctypes.Structure):
-    _fields_ = [('h', ctypes.c_int),
-                ('w', ctypes.c_int),
+    _fields_ = [('w', ctypes.c_int),
+                ('h', ctypes.c_int),
                 ('c', ctypes.c_int),
                 ('data', ctypes.POINTER(ctypes.c_float))]
 
@@ -22,6 +24,10 @@ class box (ctypes.Structure):
                 ('w', ctypes.c_float),
                 ('h', ctypes.c_float), ]
 
+class metadata (ctypes.Structure):
+    _fields_ = [('classes', ctypes.c_int),
+                ('names', ctypes.POINTER(ctypes.c_char_p))]
+
 
 # C funtions bindings
 
@@ -37,37 +43,140 @@ def test_detector(datacfg, cfgfile, weightfile, filename, thresh, hier_thresh, o
     _test_detector(datacfg, cfgfile, weightfile,
                    filename, thresh, hier_thresh, outfile)
 
+# network *load_network_p(char *cfg, char *weights, int clear)
+_load_network = mylib.load_network_p
+_load_network.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int)
+_load_network.restype = ctypes.c_void_p
 
-def read_bounding_boxes(filename):
-    """Reads bounding boxes from text file. Returns weight, height and a list of objects that were detected in the picture"""
-    f = open(filename)
-    objects = []
-    weight = 0
-    height = 0
-    for line in f:
-        print(line)
-        first_word = line.split(';')[0]
-        if first_word == "Dimensions":
-            weight = line.split(';')[1]
-            height = line.split(';')[2]
-        if first_word == "Object":
-            objects.append((line.split(';')[1], line.split(';')[2], line.split(';')[4],
-                            line.split(';')[5], line.split(';')[6], line.split(';')[7]))
-    return weight, height, objects
+# metadata get_metadata(char *file)
+_get_metadata = mylib.get_metadata
+_get_metadata.argtypes = (ctypes.c_char_p, )
+_get_metadata.restype = metadata
 
+# image load_image_color(char *filename, int w, int h)
+_load_image_color = mylib.load_image_color
+_load_image_color.argtypes = (ctypes.c_char_p, ctypes.c_int, ctypes.c_int)
+_load_image_color.restype = image
 
-def crop_bounding_box_from_image(bounding_box, image_path, with_margin=True):
-    """Returns cropped bounding box from image"""
-    original_image = Image.open(image_path)
+# void free_image(image m)
+_free_image = mylib.free_image
+_free_image.argtypes = (image, )
+_free_image.restype = None
+
+# int num_boxes(network *net)
+_num_boxes = mylib.num_boxes
+_num_boxes.argtypes = (ctypes.c_void_p, )
+_num_boxes.restype = ctypes.c_int
+
+# box *make_boxes(network *net)
+_make_boxes = mylib.make_boxes
+_make_boxes.argtypes = (ctypes.c_void_p, )
+_make_boxes.restype = ctypes.POINTER(box)
+
+# float **make_probs(network *net)
+_make_probs = mylib.make_probs
+_make_probs.argtypes = (ctypes.c_void_p, )
+_make_probs.restype = ctypes.POINTER(ctypes.POINTER(ctypes.c_float))
+
+# void network_detect(network *net, image im, float thresh, float hier_thresh, float nms,
+# box *boxes, float **probs)
+_network_detect = mylib.network_detect
+_network_detect.argtypes = (ctypes.c_void_p, image, ctypes.c_float, ctypes.c_float, ctypes.c_float,
+                            ctypes.POINTER(box), ctypes.POINTER(ctypes.POINTER(ctypes.c_float)))
+_network_detect.restype = None
+
+
+class Detector:
+    """YOLO network loaded once through darknet bindings and reused for every image.
+    Detections are read from C structures in memory, calls are serialized with a lock
+    because the network and its buffers are shared"""
+
+    def __init__(self, datacfg=b'cfg/coco.data', cfgfile=b'cfg/yolo.cfg', weightfile=b'yolo.weights',
+                 thresh=parameters.YOLO_THRES, hier_thresh=0.5, nms=parameters.YOLO_NMS):
+        self.thresh = thresh
+        self.hier_thresh = hier_thresh
+        self.nms = nms
+        self.net = _load_network(cfgfile, weightfile, 0)
+        meta = _get_metadata(datacfg)
+        self.names = [meta.names[i].decode('utf-8') for i in range(meta.classes)]
+        # boxes and probabilities buffers are sized by the network and reused between images
+        self.num = _num_boxes(self.net)
+        self.boxes = _make_boxes(self.net)
+        self.probs = _make_probs(self.net)
+        self.lock = threading.Lock()
+
+    def detect(self, image_path):
+        """Returns width, height and list of objects (class, probability, left, right, top, bottom)
+        detected in the image, in the format of bounding boxes file"""
+        im = _load_image_color(image_path.encode('utf-8'), 0, 0)
+        try:
+            with self.lock:
+                _network_detect(self.net, im, self.thresh, self.hier_thresh, self.nms, self.boxes, self.probs)
+                return im.w, im.h, self._read_objects(im)
+        finally:
+            _free_image(im)
+
+    def _read_objects(self, im):
+        """Converts boxes and probabilities buffers filled by network_detect to objects list"""
+        objects = []
+        for j in range(self.num):
+            class_probs = self.probs[j][:len(self.names)]
+            class_id = max(range(len(class_probs)), key=class_probs.__getitem__)
+            prob = class_probs[class_id]
+            if prob <= self.thresh:
+                continue
+            b = self.boxes[j]
+            left = max(int(b.x - b.w / 2.), 0)
+            right = min(int(b.x + b.w / 2.), im.w - 1)
+            top = max(int(b.y - b.h / 2.), 0)
+            bottom = min(int(b.y + b.h / 2.), im.h - 1)
+            objects.append((self.names[class_id], '%.0f%%' % (prob * 100),
+                            left, right, top, bottom))
+        return objects
+
+
+_detector = None
+_detector_lock = threading.Lock()
+
+
+def get_detector():
+    """Returns process-wide detector, network weights are loaded on first call"""
+    global _detector
+    with _detector_lock:
+        if _detector is None:
+            _detector = Detector()
+    return _detector
+
+
+def draw_detections(image_path, objects, output_path):
+    """Saves copy of image with detected objects drawn on it"""
+    with Image.open(image_path) as original_image:
+        predictions_image = original_image.convert('RGB')
+    draw = ImageDraw.Draw(predictions_image)
+    for detected_object in objects:
+        left, right, top, bottom = [int(v) for v in detected_object[2:6]]
+        draw.rectangle([left, top, right, bottom], outline=(255, 0, 102))
+        draw.text((left + 2, top + 2), detected_object[0], fill=(255, 0, 102))
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    predictions_image.save(output_path)
+
+
+def crop_box(original_image, bounding_box, with_margin=True):
+    """Returns bounding box cropped from already opened image"""
     margin_length = 0
     margin_height = 0
     if with_margin:
         # Extend bounding box length and height by 20%
         margin_length = 0.1 * (int(bounding_box[3]) - int(bounding_box[2]))
         margin_height = 0.1 * (int(bounding_box[5]) - int(bounding_box[4]))
-    cropped_image = original_image.crop((int(bounding_box[2]) - margin_length, int(bounding_box[4]) - margin_height,
-                                         int(bounding_box[3]) + margin_length, int(bounding_box[5]) + margin_height))
-    return cropped_image
+    return original_image.crop((int(bounding_box[2]) - margin_length, int(bounding_box[4]) - margin_height,
+                                int(bounding_box[3]) + margin_length, int(bounding_box[5]) + margin_height))
+
+
+def crop_bounding_box_from_image(bounding_box, image_path, with_margin=True):
+    """Returns cropped bounding box from image"""
+    original_image = Image.open(image_path)
+    return crop_box(original_image, bounding_box, with_margin)
 
 
 def crop_all_bounding_boxes(boxes, image_path, crop_path):
@@ -76,13 +185,13 @@ def crop_all_bounding_boxes(boxes, image_path, crop_path):
     for box in boxes:
         object_class = box[0]
         cropped_image = crop_bounding_box_from_image(
-            box, image_path, crop_path)
+            box, image_path)
         filename = object_class + "_" + os.path.basename(image_path)
         while os.path.isfile(os.path.join(crop_path, filename)):
             print('File %s already exists!' % (filename))
             index += 1
             filename = str(index) + "_" + filename
-        cropped_image.save(filename)
+        cropped_image.save(os.path.join(crop_path, filename))
 
 
 def crop_box_for_class(boxes, image_path, crop_path, object_class):
@@ -115,6 +224,47 @@ def crop_box_for_class(boxes, image_path, crop_path, object_class):
         return image_path
 
 
+def crop_object_for_class(boxes, image_path, object_class, min_size=140):
+    """Returns (box, crop with margin, crop to show) of the most probable box of object class,
+    cropped in memory. None when there is no such box or its crop is not larger than min_size"""
+    best_box = None
+    class_prob = 0
+    for box in boxes:
+        box_prob = float(box[1].strip('%')) / 100.0
+        if box[0] == object_class and box_prob > class_prob:
+            class_prob = box_prob
+            best_box = box
+    if best_box is None:
+        return None
+    crops = crop_objects([best_box], image_path, (object_class, ), min_size)
+    return crops[0] if crops else None
+
+
+def crop_objects(boxes, image_path, allowed_classes, min_size=140):
+    """Crops every box of allowed classes from a single decode of the image, in memory. Boxes not larger
+    than min_size are skipped. Returns list of (box, crop with margin, crop to show) in boxes order"""
+    crops = []
+    with Image.open(image_path) as original_image:
+        original_image.load()
+        for box in boxes:
+            if box[0] not in allowed_classes:
+                continue
+            cropped_image = crop_box(original_image, box, with_margin=True)
+            width, height = cropped_image.size
+            if height <= min_size or width <= min_size:
+                continue
+            crops.append((box, cropped_image, crop_box(original_image, box, with_margin=False)))
+    return crops
+
+
+_crop_writer = ThreadPoolExecutor(max_workers=parameters.CROP_WRITE_WORKERS)
+
+
+def save_crop_async(cropped_image, crop_path):
+    """Writes crop to crop_path in background thread, returns future of the write"""
+    return _crop_writer.submit(cropped_image.save, crop_path)
+
+
 def detect_class_onpic(boxes, allowed_classes):
     """For a list of bounding boxes return a class from allowed classes that has the highest probability"""
     object_class = "all"
@@ -135,62 +285,43 @@ def run_yolo_onpic(image_path):
     except:
         print('Cannot open image', image_path)
         return 0, 0, 0
-    output_file = "predictions_" + os.path.basename(image_path)
-    test_detector(b'cfg/coco.data', b'cfg/yolo.cfg', b'yolo.weights',
-                  image_path.encode('utf-8'), parameters.YOLO_THRES, 0.5, output_file.encode('utf-8'))
-    w, h, o = read_bounding_boxes('bounding_boxes.txt')
-    return w, h, o
+    return get_detector().detect(image_path)
 
 
 def run_yolo_indir(images_path):
     """For every image in images_path run YOLO object detection and crop detected objects"""
     for filename in os.listdir(images_path):
-        try:
-            # print(filename)
-            Image.open(os.path.join(images_path, filename))
-            test_detector(b'cfg/voc.data', b'cfg/yolo.cfg', b'yolo.weights', os.path.join(
-                images_path, filename).encode('utf-8'), parameters.YOLO_THRES, 0.5)
-            w, h, o = read_bounding_boxes('bounding_boxes.txt')
-            crop_all_bounding_boxes(o, filename, os.path.join, images_path)
-        except:
-            print('Cannot test image', filename)
+        w, h, o = run_yolo_onpic(os.path.join(images_path, filename))
+        if o == 0:
             continue
+        crop_all_bounding_boxes(o, os.path.join(images_path, filename), images_path)
 
 
-def detect_objects_on_image(image_path, detections_file='pickles/bounding_boxes.pickle'):
+def detect_objects_on_image(image_path, detections_file=parameters.DETECTIONS_DB):
     """For image path return a list of detected bounding boxes"""
-    image_name = os.path.basename(image_path)
-    try:
-        with open(detections_file, 'rb') as handle:
-            detections = pickle.load(handle)
-    except FileNotFoundError:
-        print('Detections file not found!')
-        detections = {}
-    if image_name in detections:
-        print(image_name, 'is already in detections file!')
-        print('Bounding boxes from file', detections[image_name])
-        return detections[image_name]
-    else:
-        print('Adding to detections file', image_name)
-        _, _, bound_boxes = run_yolo_onpic(image_path)
-        detections[image_name] = bound_boxes
-        print('Bounding boxes', bound_boxes)
-        fileObject = open(detections_file, 'wb')
-        pickle.dump(detections, fileObject)
-        fileObject.close()
+    detections = get_detection_cache(detections_file)
+    content_hash = image_hash(image_path)
+    bound_boxes = detections.get(content_hash)
+    if bound_boxes is not None:
+        print(os.path.basename(image_path), 'is already in detections cache!')
         return bound_boxes
+    print('Adding to detections cache', image_path)
+    _, _, bound_boxes = run_yolo_onpic(image_path)
+    detections.put(content_hash, os.path.basename(image_path), bound_boxes)
+    print('Bounding boxes', bound_boxes)
+    return bound_boxes
 
 
-def initiate_yolo_detect(images_path, save_to_path, detections_file='pickles/bounding_boxes.pickle'):
-    """detect objects for all images in path and save the bounding boxes to pickle path """
+def initiate_yolo_detect(images_path, save_to_path, detections_file=parameters.DETECTIONS_DB):
+    """detect objects for all images in path and save the bounding boxes to detections cache """
     for filename in os.listdir(images_path):
         bound_boxes = detect_objects_on_image(
             os.path.join(images_path, filename), detections_file)
         predictions_path = os.path.join(
             save_to_path, 'predictions_' + filename)
         print('predictions path', predictions_path)
-        copy2('predictions_' + os.path.basename(image_directory) +
-              '.png', predictions_path)
+        if bound_boxes != 0:
+            draw_detections(os.path.join(images_path, filename), bound_boxes, predictions_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,113 @@
+"""Persistent cache of YOLO detections keyed by image content hash
+
+Detections are kept in a local SQLite database, one row per image, so a lookup
+is a single primary key read and a new detection is a single insert, no matter
+how many images were seen before. The database runs in WAL mode, so many
+processes can read while one of them writes.
+
+"""
+
+import argparse
+import json
+import os
+import pickle
+import sqlite3
+import threading
+
+import parameters
+from artifacts import file_hash
+
+
+class DetectionCache:
+    """Detections stored by sha1 of image bytes, safe to share between threads and processes"""
+
+    def __init__(self, db_path=parameters.DETECTIONS_DB):
+        self.db_path = db_path
+        self._local = threading.local()
+        connection = self._connection()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS detections ('
+                               'image_hash TEXT PRIMARY KEY, image_name TEXT, boxes TEXT)')
+
+    def _connection(self):
+        """Returns sqlite connection of the calling thread"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _decode(boxes):
+        boxes = json.loads(boxes)
+        if isinstance(boxes, list):
+            return [tuple(box) for box in boxes]
+        return boxes
+
+    def get(self, image_hash):
+        """Returns cached boxes for image hash or None"""
+        row = self._connection().execute(
+            'SELECT boxes FROM detections WHERE image_hash = ?', (image_hash, )).fetchone()
+        if row is None:
+            return None
+        return self._decode(row[0])
+
+    def put(self, image_hash, image_name, boxes):
+        """Stores boxes for image hash. First writer wins, detections for the same bytes are equal"""
+        connection = self._connection()
+        with connection:
+            connection.execute('INSERT OR IGNORE INTO detections VALUES (?, ?, ?)',
+                               (image_hash, image_name, json.dumps(boxes)))
+
+    def put_many(self, entries):
+        """Stores (image hash, image name, boxes) entries in one transaction"""
+        connection = self._connection()
+        with connection:
+            connection.executemany('INSERT OR IGNORE INTO detections VALUES (?, ?, ?)',
+                                   [(h, name, json.dumps(boxes)) for h, name, boxes in entries])
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM detections').fetchone()[0]
+
+    def import_pickle(self, detections_file, image_dirs):
+        """Imports detections from pickled {image name: boxes} dict.
+        Names are resolved against image_dirs to hash image contents, names not found are skipped"""
+        with open(detections_file, 'rb') as handle:
+            detections = pickle.load(handle)
+        entries = []
+        for image_name, boxes in detections.items():
+            for image_dir in image_dirs:
+                image_path = os.path.join(image_dir, image_name)
+                if os.path.isfile(image_path):
+                    entries.append((file_hash(image_path), image_name, boxes))
+                    break
+        self.put_many(entries)
+        print('Imported %d of %d detections from %s' % (len(entries), len(detections), detections_file))
+        return len(entries)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_detection_cache(db_path=parameters.DETECTIONS_DB):
+    """Returns process-wide cache for database path"""
+    with _caches_lock:
+        if db_path not in _caches:
+            _caches[db_path] = DetectionCache(db_path)
+        return _caches[db_path]
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'detections_file',
+        help="Pickled detections dictionary, e.g. pickles/bounding_boxes.pickle")
+    parser.add_argument(
+        'image_dirs', nargs='+',
+        help="Directories with images named in the detections file")
+    parser.add_argument('--db', default=parameters.DETECTIONS_DB)
+    args = parser.parse_args()
+    get_detection_cache(args.db).import_pickle(args.detections_file, args.image_dirs)
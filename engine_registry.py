@@ -0,0 +1,123 @@
+"""Routing of detected object classes to gallery engines
+
+The registry is built from configuration: every gallery class has a directory,
+a static path of its images and optionally a text query, YOLO class names are
+mapped to gallery classes with aliases. New classes can be registered while
+the app is running, their features are stored in the engines index so other
+processes serving the same index pick them up as well.
+
+"""
+
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from dense_index import index_vectors
+from finder import cnn_descriptor
+
+EngineEntry = namedtuple('EngineEntry', ['directory', 'static_path', 'text_query'])
+
+
+class UnknownClassError(KeyError):
+    """Object class has no gallery engine"""
+
+
+class EngineRegistry(object):
+    """Maps object class names and their aliases to engine entries of the engines index"""
+
+    def __init__(self, engines_index, classes, aliases=None):
+        self.engines_index = engines_index
+        self.entries = {}
+        self.aliases = {}
+        self.lock = threading.Lock()
+        self.synced_mtime = None
+        # registrations extract features of whole galleries, they run one at a time off request threads
+        self.registrations = {}
+        self.registration_executor = ThreadPoolExecutor(max_workers=1)
+        for class_name, config in classes.items():
+            self._add_entry(class_name, config)
+        for alias, class_name in (aliases or {}).items():
+            self.aliases[alias] = class_name
+
+    def _add_entry(self, class_name, config):
+        self.entries[class_name] = EngineEntry(
+            config['dir'], config.get('static', '/static/images/' + class_name),
+            config.get('query', class_name.replace('_', ' ')))
+        for alias in config.get('aliases', ()):
+            self.aliases[alias] = class_name
+
+    def _sync(self):
+        """Routes classes registered, or rebuilt, by any process since the index was last read"""
+        self.engines_index.refresh()
+        if self.engines_index.index_mtime == self.synced_mtime:
+            return
+        for class_name, config in self.engines_index.metadata.get('registry', {}).items():
+            self._add_entry(class_name, config)
+        self.synced_mtime = self.engines_index.index_mtime
+
+    def resolve(self, object_class):
+        """Returns gallery class name of object class or alias, raises UnknownClassError"""
+        with self.lock:
+            self._sync()
+            class_name = self.aliases.get(object_class, object_class)
+            if class_name not in self.entries:
+                raise UnknownClassError(object_class)
+            return class_name
+
+    def __contains__(self, object_class):
+        try:
+            self.resolve(object_class)
+            return True
+        except UnknownClassError:
+            return False
+
+    def allowed_classes(self):
+        """Returns names and aliases of all registered classes"""
+        with self.lock:
+            self._sync()
+            return set(self.entries) | set(self.aliases)
+
+    def get(self, object_class):
+        """Returns (search directory, engine, static path) for object class"""
+        class_name = self.resolve(object_class)
+        entry = self.entries[class_name]
+        return entry.directory, self.engines_index.engine(class_name), entry.static_path
+
+    def text_query(self, object_class):
+        """Returns text query describing object class"""
+        return self.entries[self.resolve(object_class)].text_query
+
+    def register(self, class_name, directory, static_path=None, aliases=(), text_query=None):
+        """Extracts features of class gallery directory, stores them in the engines index and
+        routes class name and aliases to the new engine. Registering existing class rebuilds it"""
+        config = {'dir': directory, 'static': static_path or '/static/images/' + os.path.basename(directory),
+                  'query': text_query or class_name.replace('_', ' '), 'aliases': list(aliases)}
+        ids, matrix = index_vectors(cnn_descriptor(directory).image_index)
+        if not ids:
+            raise ValueError('No images found in %s' % directory)
+        self.engines_index.add_class(class_name, ids, matrix, registry_entry=config)
+        with self.lock:
+            self._add_entry(class_name, config)
+        print('Engine for %s registered' % class_name)
+
+    def register_async(self, class_name, directory, static_path=None, aliases=(), text_query=None):
+        """Runs register in background thread. Returns False without starting it while
+        another registration of this process is running"""
+        with self.lock:
+            if any(not future.done() for future in self.registrations.values()):
+                return False
+            self.registrations[class_name] = self.registration_executor.submit(
+                self.register, class_name, directory, static_path, aliases, text_query)
+            return True
+
+    def registration_status(self, class_name):
+        """Returns ('running' | 'registered' | 'failed' | 'unknown', error message or None) of class registration"""
+        with self.lock:
+            future = self.registrations.get(class_name)
+        if future is not None and not future.done():
+            return 'running', None
+        if future is not None and future.exception() is not None:
+            return 'failed', str(future.exception())
+        # class may have been registered by another process
+        return ('registered' if class_name in self else 'unknown'), None
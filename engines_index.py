@@ -0,0 +1,182 @@
+"""One memory-mapped file holding CNN features of every gallery class
+
+Features of all classes are stored as a single float32 matrix in an artifact
+file (see artifacts.py), rows of one class are contiguous and the header keeps
+the offsets of every class. Opening the file reads the header only. The rows
+of a class are mapped and wrapped in a dense index the first time the class
+is queried, so startup does not depend on the gallery size and processes
+serving the same file share its pages.
+
+"""
+
+import argparse
+import fcntl
+import os
+import pickle
+import threading
+
+import numpy as np
+
+import parameters
+from artifacts import open_array, read_artifact_header, save_artifact
+from cnn_feature_extraction import VisualSearchEngine_cnn
+from dense_index import DenseIndex, IVFIndex, index_vectors
+from finder import cnn_descriptor
+
+ENGINES_INDEX_VERSION = 1
+
+
+def save_engines_index(index_path, class_vectors, feature_model=parameters.FEATURE_MODEL, generations=None,
+                       registry=None):
+    """Writes {class name: (image ids, features matrix)} to a single index file.
+    generations counts how many times each class was rebuilt, so processes can tell replaced classes,
+    registry keeps routing configuration of classes registered at runtime"""
+    offsets = {}
+    ids = []
+    matrices = []
+    start = 0
+    for class_name, (class_ids, matrix) in class_vectors.items():
+        offsets[class_name] = [start, start + len(class_ids)]
+        start += len(class_ids)
+        if len(class_ids) == 0:
+            continue
+        ids.extend(class_ids)
+        matrices.append(np.asarray(matrix, dtype=np.float32).reshape(len(class_ids), -1))
+    dims = set(matrix.shape[1] for matrix in matrices)
+    if len(dims) > 1:
+        raise ValueError('Classes have features of different sizes %s' % sorted(dims))
+    features = np.vstack(matrices) if matrices else np.zeros((0, 0), dtype=np.float32)
+    metadata = {'version': ENGINES_INDEX_VERSION, 'feature_model': feature_model, 'classes': offsets,
+                'generations': generations or {}, 'registry': registry or {}}
+    save_artifact(index_path, {'ids': np.array(ids, dtype=str), 'features': features}, metadata)
+
+
+def class_features(directory, feature_model=parameters.FEATURE_MODEL):
+    """Returns (image ids, features matrix) of gallery directory. Features come from the pickled
+    per-class engine when there is one, otherwise they are extracted from the directory images"""
+    engine_file = os.path.join('pickles', os.path.basename(directory) + '_' + feature_model + '.pickle')
+    try:
+        with open(engine_file, 'rb') as handle:
+            engine = pickle.load(handle)
+        print(engine_file, 'loaded')
+    except FileNotFoundError:
+        print('No pickle file found, extracting features from', directory)
+        engine = cnn_descriptor(directory)
+    return index_vectors(engine.image_index)
+
+
+def build_engines_index(index_path, class_dirs, feature_model=parameters.FEATURE_MODEL, registry=None):
+    """Builds index file from {class name: gallery directory}. Classes of registry, registered
+    at runtime, are extracted again from their directories and keep their routing configuration"""
+    class_dirs = dict(class_dirs)
+    for class_name, config in (registry or {}).items():
+        class_dirs.setdefault(class_name, config['dir'])
+    class_vectors = {}
+    for class_name, directory in class_dirs.items():
+        class_vectors[class_name] = class_features(directory, feature_model)
+    save_engines_index(index_path, class_vectors, feature_model, registry=registry)
+    print('Engines index with %d classes written to %s' % (len(class_vectors), index_path))
+
+
+class EnginesIndex(object):
+    """Per-class visual search engines over the memory-mapped index file, created on first use.
+    Classes added to the file later, by this or another process, are picked up by refresh"""
+
+    def __init__(self, index_path, index_mode=parameters.DENSE_INDEX, metric=parameters.DENSE_METRIC):
+        self.index_path = index_path
+        self.index_mode = index_mode
+        self.metric = metric
+        self.engines = {}
+        self.index_mtime = None
+        self.lock = threading.Lock()
+        self._read_header()
+
+    def _read_header(self):
+        self.index_mtime = os.stat(self.index_path).st_mtime_ns
+        self.metadata, self.layout, self.data_start = read_artifact_header(self.index_path)
+        self.classes = dict((name, tuple(offsets)) for name, offsets in self.metadata['classes'].items())
+        self.generations = self.metadata.get('generations', {})
+        # mapped engines keep pages of the file they were opened from, replaced classes are mapped again
+        self.engines = dict((name, entry) for name, entry in self.engines.items()
+                            if entry[0] == self.generations.get(name, 0) and name in self.classes)
+
+    def refresh(self):
+        """Reads header again if the index file was replaced since it was read"""
+        with self.lock:
+            if os.stat(self.index_path).st_mtime_ns != self.index_mtime:
+                self._read_header()
+
+    def __contains__(self, class_name):
+        return class_name in self.classes
+
+    def engine(self, class_name):
+        """Returns VisualSearchEngine_cnn of class, mapping its rows on the first call"""
+        with self.lock:
+            if class_name not in self.engines:
+                start, end = self.classes[class_name]
+                ids = open_array(self.index_path, self.layout['ids'], self.data_start)[start:end].tolist()
+                matrix = open_array(self.index_path, self.layout['features'], self.data_start)[start:end]
+                index_class = IVFIndex if self.index_mode == 'ivf' else DenseIndex
+                self.engines[class_name] = (self.generations.get(class_name, 0), VisualSearchEngine_cnn(
+                    index_class.from_matrix(ids, matrix, metric=self.metric)))
+                print('Engine for %s mapped, %d images' % (class_name, len(ids)))
+            return self.engines[class_name][1]
+
+    def add_class(self, class_name, ids, matrix, registry_entry=None):
+        """Stores features of a new class, or replaces an existing one, and makes it available.
+        The index file is rewritten and moved in place, writers in different processes are serialized"""
+        with open(self.index_path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.refresh()
+            with self.lock:
+                class_vectors = {}
+                features = open_array(self.index_path, self.layout['features'], self.data_start)
+                all_ids = open_array(self.index_path, self.layout['ids'], self.data_start)
+                for name, (start, end) in self.classes.items():
+                    if name != class_name:
+                        class_vectors[name] = (all_ids[start:end].tolist(), features[start:end])
+                class_vectors[class_name] = (list(ids), matrix)
+                generations = dict(self.generations)
+                generations[class_name] = generations.get(class_name, 0) + 1
+                registry = dict(self.metadata.get('registry', {}))
+                if registry_entry is not None:
+                    registry[class_name] = registry_entry
+                save_engines_index(self.index_path, class_vectors, self.metadata.get('feature_model'),
+                                   generations, registry)
+                self._read_header()
+        print('Class %s with %d images added to %s' % (class_name, len(ids), self.index_path))
+
+
+def load_engines_index(index_path, class_dirs, feature_model=parameters.FEATURE_MODEL):
+    """Returns engines index, building it first when it is missing or made with another model.
+    Configured classes missing from the index are appended, other classes keep their rows"""
+    registry = None
+    try:
+        engines_index = EnginesIndex(index_path)
+        registry = engines_index.metadata.get('registry')
+        if engines_index.metadata.get('feature_model') == feature_model and \
+                engines_index.metadata.get('version') == ENGINES_INDEX_VERSION:
+            for class_name, directory in class_dirs.items():
+                if class_name not in engines_index:
+                    print('Class %s missing from engines index, adding' % class_name)
+                    engines_index.add_class(class_name, *class_features(directory, feature_model))
+            print('Engines index loaded from', index_path)
+            return engines_index
+        print('Engines index in', index_path, 'is out of date, rebuilding')
+    except (FileNotFoundError, ValueError):
+        print('No engines index found in', index_path + ', building')
+    build_engines_index(index_path, class_dirs, feature_model, registry)
+    return EnginesIndex(index_path)
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'index',
+        help="Path of the engines index to be written, e.g. pickles/engines_resnet.bin")
+    parser.add_argument(
+        'classes', nargs='+',
+        help="Gallery classes as name=directory, e.g. chair=app/static/images/chair")
+    args = parser.parse_args()
+    build_engines_index(args.index, dict(entry.split('=', 1) for entry in args.classes))
@@ -0,0 +1,181 @@
+"""Incremental on-disk cache of CNN features
+
+Features are rows of a preallocated float32 matrix stored as .npy file and
+opened as memory map, image names are kept in a JSON index next to it. New
+features are written into free rows and flushed before the index that refers
+to them is atomically replaced, so a crash never leaves the index pointing at
+unwritten rows. When the matrix is full it is copied to a file twice as large,
+which is moved in place the same way. Writers in different processes are
+serialized with a lock file.
+
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import pickle
+import threading
+
+import numpy as np
+
+import parameters
+from image_hashes import image_hash
+
+
+class FeatureCache:
+    """Features of images stored by image key, e.g. content hash, in a memory-mapped matrix"""
+
+    def __init__(self, cache_prefix, capacity=parameters.FEATURE_CACHE_CAPACITY):
+        self.matrix_path = cache_prefix + '.npy'
+        self.index_path = cache_prefix + '.json'
+        self.lock_path = cache_prefix + '.lock'
+        self.initial_capacity = capacity
+        self.lock = threading.Lock()
+        self.ids = []
+        self.id_to_row = {}
+        self.matrix = None
+        self.index_mtime = None
+        self._reload()
+
+    def _reload(self):
+        """Reads index and maps matrix again if another process changed them"""
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.index_mtime:
+            return
+        with open(self.index_path) as f:
+            self.ids = json.load(f)['ids']
+        self.id_to_row = {image_name: row for row, image_name in enumerate(self.ids)}
+        self.matrix = np.load(self.matrix_path, mmap_mode='r+')
+        self.index_mtime = mtime
+
+    def __contains__(self, image_name):
+        with self.lock:
+            if image_name not in self.id_to_row:
+                self._reload()
+            return image_name in self.id_to_row
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, image_name):
+        """Returns copy of features for image name or None. On a miss the index is read again
+        when another process changed it"""
+        with self.lock:
+            row = self.id_to_row.get(image_name)
+            if row is None:
+                self._reload()
+                row = self.id_to_row.get(image_name)
+            if row is None:
+                return None
+            return np.array(self.matrix[row])
+
+    def add(self, image_name, features):
+        self.add_many([(image_name, features)])
+
+    def add_many(self, entries):
+        """Appends (image name, features) entries, names already in cache are skipped"""
+        entries = list(entries)
+        if not entries:
+            return
+        with self.lock, open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._reload()
+            new_entries = {}
+            for image_name, features in entries:
+                if image_name not in self.id_to_row:
+                    new_entries[image_name] = np.asarray(features, dtype=np.float32).ravel()
+            if not new_entries:
+                return
+            rows = np.vstack(list(new_entries.values()))
+            start = len(self.ids)
+            self._ensure_capacity(start + len(rows), rows.shape[1])
+            self.matrix[start:start + len(rows)] = rows
+            self.matrix.flush()
+            self.ids.extend(new_entries)
+            for row, image_name in enumerate(new_entries, start):
+                self.id_to_row[image_name] = row
+            self._write_index()
+
+    def _ensure_capacity(self, rows, dim):
+        """Grows matrix file so that it holds at least rows vectors"""
+        if self.matrix is not None and len(self.matrix) >= rows:
+            return
+        capacity = max(self.initial_capacity, rows)
+        if self.matrix is not None:
+            capacity = max(capacity, 2 * len(self.matrix))
+        tmp_path = '%s.%d.tmp.npy' % (self.matrix_path[:-4], os.getpid())
+        grown = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(capacity, dim))
+        if self.matrix is not None:
+            grown[:len(self.ids)] = self.matrix[:len(self.ids)]
+        grown.flush()
+        del grown
+        os.replace(tmp_path, self.matrix_path)
+        self.matrix = np.load(self.matrix_path, mmap_mode='r+')
+
+    def _write_index(self):
+        tmp_path = '%s.%d.tmp' % (self.index_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'ids': self.ids}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+        self.index_mtime = os.stat(self.index_path).st_mtime_ns
+
+    def import_pickle(self, features_file, image_dirs):
+        """Imports features from pickled {image name: features} dict. Names are resolved
+        against image_dirs and stored by image content hash, names not found are skipped.
+        Crops saved by the old app, named <class>_<image>, are skipped as well: crop features
+        are keyed by source image and box now, so imported rows could never be looked up"""
+        with open(features_file, 'rb') as handle:
+            features_set = pickle.load(handle)
+        entries = []
+        crops = 0
+        for image_name, features in features_set.items():
+            if is_legacy_crop(image_name):
+                crops += 1
+                continue
+            for image_dir in image_dirs:
+                image_path = os.path.join(image_dir, image_name)
+                if os.path.isfile(image_path):
+                    entries.append((image_hash(image_path), features))
+                    break
+        self.add_many(entries)
+        print('Imported %d of %d features from %s, %d object crops skipped' %
+              (len(entries), len(features_set), features_file, crops))
+        return len(entries)
+
+
+def is_legacy_crop(image_name):
+    """Returns True for names of object crops saved by the old app, e.g. chair_scene.jpg or 2chair_show_scene.jpg"""
+    prefix = image_name.lstrip('2').split('_', 1)
+    return len(prefix) == 2 and prefix[0] in parameters.ALLOWED_CLASSES
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_feature_cache(cache_prefix=parameters.OBJECT_FEATURES_CACHE):
+    """Returns process-wide feature cache for path prefix"""
+    with _caches_lock:
+        if cache_prefix not in _caches:
+            _caches[cache_prefix] = FeatureCache(cache_prefix)
+        return _caches[cache_prefix]
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'features_file',
+        help="Pickled features dictionary keyed by image names")
+    parser.add_argument(
+        'image_dirs', nargs='+',
+        help="Directories with images named in the features file")
+    parser.add_argument('--cache', default=parameters.OBJECT_FEATURES_CACHE)
+    args = parser.parse_args()
+    get_feature_cache(args.cache).import_pickle(args.features_file, args.image_dirs)
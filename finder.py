@@ -1,19 +1,20 @@
 """Functions to build image retrieval engine """
 
 import csv
+import numpy as np
 import logging.config
-import operator
 import os
 import pickle
 import time
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import vse
 import yaml
 
 import parameters
-from detect_objects import run_yolo_onpic, crop_box_for_class
-from processing_images import read_image
-from cnn_feature_extraction import VisualSearchEngine_cnn
+from detect_objects import crop_object_for_class, detect_class_onpic, detect_objects_on_image
+from geom_check import geometric_rerank
+from image_hashes import crop_key, image_hash
 
 
 def setup_logging(
@@ -69,21 +70,13 @@ def load(filename):
         return pickle.load(file)
 
 
-def cnn_descriptor(
-        directory,
-        features_clusters):
-    ranker = vse.SimpleRanker(hist_comparator=vse.Intersection())
-    index = vse.InvertedIndex(ranker=ranker,
-                              recognized_visual_words=features_clusters)
-    vse_engine = VisualSearchEngine_cnn(index)
-    for filename in os.listdir(directory):
-        ndir = os.path.join(directory, filename)
-        try:
-            image = Image.open(filename)
-            vse_engine.add_to_index_cnn(filename, image, ndir)
-        except OSError:
-            print('Not an image', filename)
-            continue
+def cnn_descriptor(directory):
+    # imported here, so bovw engines work without keras installed
+    from cnn_feature_extraction import create_vse
+    vse_engine = create_vse()
+    image_paths = [os.path.join(directory, filename) for filename in os.listdir(directory)
+                   if os.path.isfile(os.path.join(directory, filename))]
+    vse_engine.add_many_to_index_cnn(image_paths)
     return vse_engine
 
 
@@ -93,24 +86,7 @@ def geom_check(query_img, result, results_dir, nb_best):
     """
     if nb_best > parameters.NB_MATCHES:
         return result  # more best matches to be returned than are given
-    match_inliers = {}
-    for match in result:
-        match_img = read_image(match[0], results_dir)
-        inliers = ransac_test_onmatch(query_img, match_img)
-        if inliers > 0:
-            match_inliers[match[0]] = inliers
-    # if we don't have enough matches, add the best matches from initial result
-    if len(match_inliers) < nb_best:
-        nb_to_be_added = min(nb_best - len(match_inliers), len(result))
-        for i in range(0, nb_to_be_added):
-            if result[i][0] in match_inliers:
-                i += 1
-                nb_to_be_added += 1
-            match_inliers[result[i][0]] = 0
-    # Return nb_best of the matches with highest nb of inliers
-    best_matches = dict(sorted(match_inliers.items(),
-                               key=operator.itemgetter(1), reverse=True)[:nb_best])
-    return best_matches
+    return geometric_rerank(query_img, [match[0] for match in result], results_dir, nb_best)
 
 
 def evaluation_test(query, result, ground_truth):
@@ -140,9 +116,17 @@ def test_on_set(test_set, results_set, engine, ground_truth):
         try:
             test_image = Image.open(ndir)
             img_count += 1
-            _, _, boxes = run_detector_onpic(ndir)
-            crop_clock = crop_box_for_class(boxes, ndir, BOXES_DIR, 'clock')
-            best_result = return_similar(crop_clock, results_set, engine)
+            crop = None
+            if parameters.YOLO:
+                boxes = detect_objects_on_image(ndir)
+                if boxes:
+                    object_class, _ = detect_class_onpic(boxes, parameters.ACCURACY_CLASSES)
+                    crop = crop_object_for_class(boxes, ndir, object_class)
+            if crop is None:
+                best_result = return_similar(ndir, results_set, engine)
+            else:
+                best_result = return_similar(ndir, results_set, engine, image=crop[1],
+                                             image_key=crop_key(image_hash(ndir), crop[0]))
             eval1 = evaluation_test(
                 filename, best_result, ground_truth_data)
             # update sum of corrects with 0 or 1
@@ -161,16 +145,14 @@ def test_on_set(test_set, results_set, engine, ground_truth):
 
 
 def initiate_engine(results_dir, feature_model, vocabulary=None):
+    """Returns engine of gallery directory for feature model. Vocabulary file of bovw model
+    defaults to the one in processed subdirectory of results_dir"""
     if feature_model == "bovw":
-        print('BOVW model not supported in web app!')
+        # bovw_index imports create_visual_vocabulary, which imports this module
+        from bovw_index import load_bovw_engine
+        vse_engine = load_bovw_engine(results_dir, vocabulary)
     else:
-        if feature_model == "resnet":
-            features_dim = 2048
-        else:
-            features_dim = 4096
-        vse_engine = cnn_descriptor(
-            results_dir,
-            features_dim)
+        vse_engine = cnn_descriptor(results_dir)
         file_name = os.path.join(
             'pickles/', os.path.basename(results_dir) + '_' + feature_model + '.pickle')
         fileObject = open(file_name, 'wb')
@@ -179,18 +161,18 @@ def initiate_engine(results_dir, feature_model, vocabulary=None):
     return vse_engine
 
 
-def return_similar(filename, results_dir, engine, nb_matches=parameters.NB_MATCHES, geom_check=False, nb_best=parameters.NB_BEST):
-    """Main function for returning similar images"""
+def return_similar(filename, results_dir, engine, nb_matches=parameters.NB_MATCHES, geom_check=parameters.GEOM_CHECK,
+                   nb_best=parameters.NB_BEST, image=None, image_key=None):
+    """Main function for returning similar images. Already decoded image, e.g. an in-memory crop,
+    with its content key is searched instead of reading filename when given"""
     print('Return_similar for', filename)
     try:
-        test_image = Image.open(filename)
-        if parameters.FEATURE_MODEL == "bovw":
-            result = engine.find_similar(test_image, nb_matches)
-        else:
-            result = engine.find_similar(filename, nb_matches)
+        test_image = Image.open(filename) if image is None else image
+        result = engine.find_similar(filename, nb_matches, image, image_key)
         # print('result is ', result)
         if geom_check:
-            print('Geom check is not supported in web app!')
+            query_img = np.asarray(test_image.convert('L'))
+            return geometric_rerank(query_img, [entry[0] for entry in result], results_dir, nb_best)
         else:
             best_result = {}
             for entry in result:
@@ -200,3 +182,20 @@ def return_similar(filename, results_dir, engine, nb_matches=parameters.NB_MATCH
     except OSError:
         print('Wrong image file!', filename)
         return ('not_found.jpg', 0)
+
+
+def return_similar_many(queries, nb_matches=parameters.NB_MATCHES, workers=parameters.ENGINE_QUERY_WORKERS,
+                        geom_check=parameters.GEOM_CHECK, nb_best=parameters.NB_BEST):
+    """Returns result dict, as return_similar does, for every (engine, query features, results dir, image)
+    query. Engines are queried in parallel, results of queries with decoded image are verified
+    geometrically against results dir when geom_check is set"""
+    def search(query):
+        engine, query_features, results_dir, image = query
+        result = engine.find_similar_features(query_features, nb_matches)
+        if geom_check and image is not None:
+            return geometric_rerank(np.asarray(image.convert('L')), [entry[0] for entry in result],
+                                    results_dir, nb_best)
+        return dict((entry[0], 0) for entry in result)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(search, queries))
@@ -1,54 +1,91 @@
 """Geometrical verification check"""
 
+import argparse
 import cv2
 import logging
 import numpy as np
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+
 import parameters
+from keypoint_store import KEYPOINT_STORE_VERSION, KeypointStore, save_keypoint_store
 from processing_images import *
 
 
-def find_homography(match_img, query_img, extractor, matcher, ransac_thres=15):
+MATCHERS = ('bf', 'flann', 'numpy')
+
+
+def build_flann_index(descriptors, trees=parameters.FLANN_TREES):
+    """Returns FLANN KD-tree index over gallery descriptors, reusable for every query"""
+    return cv2.flann_Index(np.ascontiguousarray(descriptors, dtype=np.float32),
+                           {'algorithm': 1, 'trees': trees})
+
+
+def match_descriptors(match_des, query_des, matcher=parameters.MATCHER, ratio=parameters.RATIO_TEST,
+                      flann_index=None):
+    """Returns (match rows, query rows) of descriptor pairs passing Lowe's ratio test.
+    matcher is a mode in MATCHERS or an OpenCV matcher object. bf and numpy find two nearest query
+    descriptors of every match descriptor, flann searches query descriptors in the match image index"""
+    empty = np.zeros(0, dtype=np.int64)
+    if match_des is None or query_des is None or len(match_des) < 2 or len(query_des) < 2:
+        return empty, empty
+    match_des = np.asarray(match_des, dtype=np.float32)
+    query_des = np.asarray(query_des, dtype=np.float32)
+    if matcher == 'numpy':
+        # squared distances of all pairs in one matrix product
+        distances = (match_des ** 2).sum(axis=1)[:, None] - 2 * match_des.dot(query_des.T) + \
+            (query_des ** 2).sum(axis=1)[None, :]
+        nearest = np.argpartition(distances, 1, axis=1)[:, :2]
+        rows = np.arange(len(match_des))[:, None]
+        nearest = nearest[rows, np.argsort(distances[rows, nearest], axis=1)]
+        best = np.sqrt(np.maximum(distances[rows, nearest], 0))
+        good = best[:, 0] < ratio * best[:, 1]
+        return np.flatnonzero(good), nearest[good, 0]
+    if matcher == 'flann':
+        flann_index = flann_index if flann_index is not None else build_flann_index(match_des)
+        nearest, distances = flann_index.knnSearch(query_des, 2, params={'checks': parameters.FLANN_CHECKS})
+        best = np.sqrt(np.maximum(distances, 0))
+        good = best[:, 0] < ratio * best[:, 1]
+        return nearest[good, 0].astype(np.int64), np.flatnonzero(good)
+    if isinstance(matcher, str):
+        if matcher != 'bf':
+            raise ValueError('Unknown matcher %s, use one of %s' % (matcher, MATCHERS))
+        matcher = cv2.BFMatcher()
+    pairs = np.array([(m.queryIdx, m.trainIdx, m.distance, n.distance)
+                      for m, n in (pair for pair in matcher.knnMatch(match_des, query_des, k=2) if len(pair) == 2)])
+    if len(pairs) == 0:
+        return empty, empty
+    good = pairs[:, 2] < ratio * pairs[:, 3]
+    return pairs[good, 0].astype(np.int64), pairs[good, 1].astype(np.int64)
+
+
+def find_homography(match_img, query_img, extractor, matcher=parameters.MATCHER, ransac_thres=15):
     """Find homography with RANSAC algorithm between source and destination points
-    for query and match image features """
+    for query and match image features. Returns inliers mask and (match rows, query rows) of good matches"""
     mask = np.empty([1, 1])
-    good = []
-    if match_img is not None:
-        if query_img is not None:
-            kp1, des1 = extractor.detectAndCompute(match_img, None)
-            kp2, des2 = extractor.detectAndCompute(query_img, None)
-            matches = matcher.knnMatch(des1, des2, k=2)  # Match
-            # Store all good matches as per Lowe's ratio test
-            if len(matches) > 0:
-                for m, n in matches:
-                    if m.distance < 0.8 * n.distance:
-                        good.append(m)
-                if len(
-                        good) > parameters.MIN_MATCH_COUNT:  # condition for min number of matches
-                    src_pts = np.float32(
-                        [kp1[m.queryIdx].pt for m in good]).reshape(-1, 1, 2)
-                    dst_pts = np.float32(
-                        [kp2[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
-                    # Find homography between source and destination points
-                    H, mask = cv2.findHomography(
-                        src_pts, dst_pts, cv2.RANSAC, ransac_thres)
+    good = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    if match_img is not None and query_img is not None:
+        match_points, match_des = extract_keypoints(match_img, extractor)
+        query_points, query_des = extract_keypoints(query_img, extractor)
+        good = match_descriptors(match_des, query_des, matcher)
+        if len(good[0]) > parameters.MIN_MATCH_COUNT:  # condition for min number of matches
+            # Find homography between source and destination points
+            H, mask = cv2.findHomography(match_points[good[0]].reshape(-1, 1, 2),
+                                         query_points[good[1]].reshape(-1, 1, 2), cv2.RANSAC, ransac_thres)
     return mask, good
 
 
-def ransac_test_onmatch(match_img, query_img, contrast=0.04, edge=10, ransac_thres=15):
+def ransac_test_onmatch(match_img, query_img, contrast=0.04, edge=10, ransac_thres=15, matcher=parameters.MATCHER):
     """Return number of inliers for given match and query images"""
-    extractor = cv2.xfeatures2d.SIFT_create(
-        nfeatures=parameters.FEATURES_CLUSTERS,
-        contrastThreshold=contrast,
-        edgeThreshold=edge)
-    matcher = cv2.BFMatcher()
+    extractor = create_extractor(contrast, edge)
     inliers = 0
     mask, _ = find_homography(match_img, query_img,
                               extractor, matcher, ransac_thres)
     if mask is not None:
-        matchesMask = mask.ravel().tolist()
-        if matchesMask is not None:
-            inliers = sum(1 for i in matchesMask if i == 1)
+        inliers = int((mask.ravel() == 1).sum())
     return inliers
 
 
@@ -84,3 +121,216 @@ def show_inliers(match_img, query_img, contrast=0.04, edge=10, ransac_thres=15):
             **draw_params)
         ndir3 = os.path.join(parameters.RESULTS_DIR, 'show_inliers.jpg')
         cv2.imwrite(ndir3, img3)
+
+
+def create_extractor(contrast=0.04, edge=10):
+    """Returns SIFT extractor used for geometric verification"""
+    # SIFT moved from contrib to the main module in OpenCV 4.4
+    sift_create = cv2.xfeatures2d.SIFT_create if hasattr(cv2, 'xfeatures2d') else cv2.SIFT_create
+    return sift_create(nfeatures=parameters.FEATURES_CLUSTERS, contrastThreshold=contrast, edgeThreshold=edge)
+
+
+def extract_keypoints(img, extractor=None):
+    """Returns (points, descriptors) float32 arrays of SIFT keypoints of grayscale image"""
+    extractor = extractor or create_extractor()
+    key_points, descriptors = extractor.detectAndCompute(img, None)
+    if descriptors is None or len(key_points) == 0:
+        return np.zeros((0, 2), dtype=np.float32), np.zeros((0, 128), dtype=np.float32)
+    return np.float32([kp.pt for kp in key_points]), np.asarray(descriptors, dtype=np.float32)
+
+
+def count_inliers(query_keypoints, match_keypoints, matcher=parameters.MATCHER, ratio=parameters.RATIO_TEST,
+                  ransac_thres=parameters.RANSAC_THRES, flann_index=None):
+    """Returns number of RANSAC homography inliers among ratio test matches of two keypoint sets"""
+    match_points, match_des = match_keypoints
+    query_points, query_des = query_keypoints
+    match_rows, query_rows = match_descriptors(match_des, query_des, matcher, ratio, flann_index)
+    if len(match_rows) <= parameters.MIN_MATCH_COUNT:
+        return 0
+    src_pts = np.asarray(match_points)[match_rows].reshape(-1, 1, 2)
+    dst_pts = np.asarray(query_points)[query_rows].reshape(-1, 1, 2)
+    _, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, ransac_thres)
+    return 0 if mask is None else int(mask.sum())
+
+
+def keypoint_store_path(directory):
+    """Returns path of keypoint store of gallery directory"""
+    return os.path.join('pickles', 'keypoints_' + os.path.basename(os.path.normpath(directory)) + '.bin')
+
+
+def gallery_files(directory):
+    """Returns {filename: [size, modification time]} of files in gallery directory"""
+    files = {}
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            stat = entry.stat()
+            files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+def _image_keypoints(args):
+    filename, directory = args
+    img = read_image(filename, directory)
+    if img is None:
+        return None
+    return (filename, ) + extract_keypoints(img)
+
+
+def build_keypoint_store(directory, store_path=None, workers=parameters.GEOM_WORKERS, previous=None):
+    """Extracts keypoints of all images in gallery directory in a process pool and writes them to store.
+    Keypoints of images unchanged since previous store was built are copied from it"""
+    store_path = store_path or keypoint_store_path(directory)
+    files = gallery_files(directory)
+    old_files = previous.metadata.get('files', {}) if previous is not None else {}
+    entries = dict((f, (f, ) + tuple(np.asarray(a) for a in previous.get(f))) for f in sorted(files)
+                   if old_files.get(f) == files[f] and f in previous)
+    new_files = [f for f in sorted(files) if f not in entries]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for entry in pool.map(_image_keypoints, [(f, directory) for f in new_files], chunksize=8):
+            if entry is not None:
+                entries[entry[0]] = entry
+    save_keypoint_store(store_path, [entries[f] for f in sorted(entries)], {'directory': directory, 'files': files})
+    print('Keypoints of %d images written to %s, %d extracted' % (len(entries), store_path, len(new_files)))
+    return store_path
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_keypoint_store(directory):
+    """Returns process-wide keypoint store of gallery directory, building it on first use.
+    Store is extended when images of the directory were added, replaced or removed since it was built"""
+    store_path = keypoint_store_path(directory)
+    with _stores_lock:
+        store = _stores.get(store_path)
+        directory_mtime = os.stat(directory).st_mtime_ns
+        # listing the directory is needed only when its entries changed since last check
+        if store is not None and store.directory_mtime == directory_mtime:
+            return store
+        files = gallery_files(directory)
+        try:
+            # another process may have updated the store already
+            store = KeypointStore(store_path)
+            if store.version != KEYPOINT_STORE_VERSION:
+                raise ValueError('Keypoint store %s is out of date' % store_path)
+        except (FileNotFoundError, ValueError):
+            print('No keypoint store found in', store_path + ', building')
+            store = KeypointStore(build_keypoint_store(directory, store_path))
+        if store.metadata.get('files') != files:
+            print('Images of', directory, 'changed, updating', store_path)
+            store = KeypointStore(build_keypoint_store(directory, store_path, previous=store))
+        store.directory_mtime = directory_mtime
+        _stores[store_path] = store
+        return store
+
+
+# FLANN indexes of gallery images built in this process, reused by later queries
+_flann_indexes = OrderedDict()
+
+
+def _gallery_flann_index(store, image_id, descriptors):
+    key = (store.store_path, store.mtime, image_id)
+    if key in _flann_indexes:
+        _flann_indexes.move_to_end(key)
+    else:
+        _flann_indexes[key] = build_flann_index(descriptors)
+        while len(_flann_indexes) > parameters.FLANN_INDEXES_CACHED:
+            _flann_indexes.popitem(last=False)
+    return _flann_indexes[key]
+
+
+def _verify_candidate(args):
+    """Process pool task, counts inliers of query keypoints against a gallery image"""
+    store_path, store_mtime, image_id, query_keypoints, matcher = args
+    if store_path not in _stores or _stores[store_path].mtime != store_mtime:
+        _stores[store_path] = KeypointStore(store_path)
+    store = _stores[store_path]
+    match_keypoints = store.get(image_id)
+    if match_keypoints is None:
+        return 0
+    flann_index = None
+    if matcher == 'flann' and len(match_keypoints[1]) >= 2:
+        flann_index = _gallery_flann_index(store, image_id, match_keypoints[1])
+    return count_inliers(query_keypoints, match_keypoints, matcher, flann_index=flann_index)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers=parameters.GEOM_WORKERS):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers)
+        return _pool
+
+
+def geometric_rerank(query_img, candidates, directory, nb_best=parameters.NB_BEST,
+                     budget=parameters.GEOM_BUDGET, matcher=parameters.MATCHER):
+    """Returns dict of nb_best candidate image ids of gallery directory to number of inliers, most inliers first.
+    Query keypoints are computed once, candidates are verified in a process pool against stored gallery
+    keypoints. Candidates not verified within budget seconds count 0 inliers and keep their rank"""
+    store = get_keypoint_store(directory)
+    query_keypoints = extract_keypoints(query_img)
+    tasks = [(store.store_path, store.mtime, image_id, query_keypoints, matcher) for image_id in candidates]
+    futures = [_get_pool().submit(_verify_candidate, task) for task in tasks]
+    done, not_done = wait(futures, timeout=budget)
+    for future in not_done:
+        future.cancel()
+    if not_done:
+        print('Geometric verification of %d candidates did not fit in %.2fs' % (len(not_done), budget))
+    inliers = [future.result() if future in done else 0 for future in futures]
+    ranked = sorted(range(len(candidates)), key=lambda i: (-inliers[i], i))[:nb_best]
+    return dict((candidates[i], inliers[i]) for i in ranked)
+
+
+def benchmark_matchers(directory, nb_queries=10, nb_candidates=parameters.NB_MATCHES):
+    """Compares matchers on gallery directory. Every query is a cropped and rescaled gallery image matched
+    against itself and random gallery images, reports time per pair, mean inliers of the true pair
+    and mean inliers of other pairs"""
+    store = get_keypoint_store(directory)
+    random_state = np.random.RandomState(0)
+    queries = []
+    for image_id in random_state.choice(store.ids, min(nb_queries, len(store)), replace=False):
+        img = read_image(image_id, directory)
+        height, width = img.shape[:2]
+        img = cv2.resize(img[height // 10:, width // 10:], None, fx=0.8, fy=0.8)
+        others = [i for i in random_state.choice(store.ids, nb_candidates, replace=False) if i != image_id]
+        queries.append((extract_keypoints(img), image_id, others[:nb_candidates - 1]))
+    print('%s: %d queries, %d candidates each' % (directory, len(queries), nb_candidates))
+    for matcher in MATCHERS:
+        flann_indexes = {}
+        if matcher == 'flann':
+            # gallery side indexes are built once, as the verifying processes keep them
+            start = time.time()
+            flann_indexes = dict((i, build_flann_index(store.get(i)[1])) for i in store.ids if len(store.get(i)[1]) >= 2)
+            print('    flann indexes of %d gallery images built in %.2fs' % (len(flann_indexes), time.time() - start))
+        true_inliers = []
+        other_inliers = []
+        start = time.time()
+        for query_keypoints, image_id, others in queries:
+            for candidate in [image_id] + others:
+                inliers = count_inliers(query_keypoints, store.get(candidate), matcher,
+                                        flann_index=flann_indexes.get(candidate))
+                (true_inliers if candidate == image_id else other_inliers).append(inliers)
+        pairs = len(true_inliers) + len(other_inliers)
+        print('    %-6s %.2f ms/pair    true pair inliers %.1f    other pairs inliers %.1f' % (
+            matcher, (time.time() - start) / pairs * 1000, np.mean(true_inliers), np.mean(other_inliers)))
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'directories', nargs='+',
+        help="Gallery directories to extract keypoints for, e.g. app/static/images/chair")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="Compare matchers on the directories instead of only building keypoint stores")
+    args = parser.parse_args()
+    for directory in args.directories:
+        if args.benchmark:
+            benchmark_matchers(directory)
+        else:
+            build_keypoint_store(directory)
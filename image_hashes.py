@@ -0,0 +1,74 @@
+"""Content keys of images shared by detection, cropping and feature caches
+
+Images are identified by sha1 of their bytes, so the same picture uploaded
+under different names is computed once and different pictures sharing a name
+are never confused. Hashes are remembered by path, size and modification time,
+so a file is read once however many caches look it up. Hashes of whole
+catalogs can be persisted in a JSON memo file, so restarted processes only
+read files that changed. Crops are keyed by the hash of their source image and
+the cropped box.
+
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from artifacts import file_hash
+
+# number of file hashes remembered by path
+MEMO_SIZE = 4096
+
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+def image_hash(image_path):
+    """Returns sha1 hex digest of image file contents"""
+    stat = os.stat(image_path)
+    memo_key = (os.path.realpath(image_path), stat.st_size, stat.st_mtime_ns)
+    with _memo_lock:
+        digest = _memo.get(memo_key)
+        if digest is not None:
+            _memo.move_to_end(memo_key)
+            return digest
+    digest = file_hash(image_path)
+    with _memo_lock:
+        _memo[memo_key] = digest
+        while len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+    return digest
+
+
+def image_hash_many(image_paths, memo_path):
+    """Returns sha1 hex digests of image files. Digests are remembered in memo_path by path,
+    size and modification time, only files missing from it or changed since are read"""
+    try:
+        with open(memo_path) as f:
+            memo = json.load(f)
+    except (FileNotFoundError, ValueError):
+        memo = {}
+    digests = []
+    changed = False
+    for image_path in image_paths:
+        stat = os.stat(image_path)
+        path = os.path.realpath(image_path)
+        entry = memo.get(path)
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            entry = [stat.st_size, stat.st_mtime_ns, image_hash(image_path)]
+            memo[path] = entry
+            changed = True
+        digests.append(entry[2])
+    if changed:
+        tmp_path = '%s.%d.tmp' % (memo_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(memo, f)
+        os.replace(tmp_path, memo_path)
+    return digests
+
+
+def crop_key(source_hash, box, with_margin=True):
+    """Returns key of bounding box cropped from image with source_hash"""
+    left, right, top, bottom = [int(v) for v in box[2:6]]
+    return '%s:%d,%d,%d,%d%s' % (source_hash, left, right, top, bottom, ':margin' if with_margin else '')
@@ -0,0 +1,70 @@
+"""On-disk store of SIFT keypoints and descriptors of gallery images
+
+Keypoint coordinates and descriptors of all images of a gallery directory are
+concatenated into two float32 matrices of an artifact file (see artifacts.py),
+offsets give the rows of every image. The matrices are memory-mapped, so
+geometric verification reads only the rows of the candidates it checks and
+processes verifying the same gallery share pages.
+
+"""
+
+import os
+
+import numpy as np
+
+from artifacts import load_artifact, save_artifact
+
+KEYPOINT_STORE_VERSION = 1
+
+
+def save_keypoint_store(store_path, entries, metadata=None):
+    """Writes (image id, keypoint points, descriptors) entries to store_path"""
+    entries = list(entries)
+    counts = [len(points) for _, points, _ in entries]
+    offsets = np.zeros(len(entries) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    points = [np.asarray(p, dtype=np.float32).reshape(-1, 2) for _, p, _ in entries]
+    descriptors = [np.asarray(d, dtype=np.float32) for _, _, d in entries]
+    dims = set(d.shape[-1] for d in descriptors if d.size)
+    dim = dims.pop() if dims else 128
+    # images without keypoints are stored with zero rows
+    descriptors = [d.reshape(-1, dim) for d in descriptors]
+    arrays = {
+        'ids': np.array([image_id for image_id, _, _ in entries], dtype=str),
+        'offsets': offsets,
+        'points': np.vstack(points) if points else np.zeros((0, 2), dtype=np.float32),
+        'descriptors': np.vstack(descriptors) if descriptors
+        else np.zeros((0, dim), dtype=np.float32),
+    }
+    metadata = dict(metadata or {}, version=KEYPOINT_STORE_VERSION)
+    save_artifact(store_path, arrays, metadata)
+
+
+class KeypointStore(object):
+    """Keypoints and descriptors of gallery images by image id, read from memory-mapped store"""
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        # identifies the file read, stores replaced later have another mtime
+        self.mtime = os.stat(store_path).st_mtime_ns
+        self.metadata, arrays = load_artifact(store_path)
+        self.version = self.metadata.get('version')
+        self.ids = arrays['ids'].tolist()
+        self.id_to_row = {image_id: row for row, image_id in enumerate(self.ids)}
+        self.offsets = np.asarray(arrays['offsets'])
+        self.points = arrays['points']
+        self.descriptors = arrays['descriptors']
+
+    def __contains__(self, image_id):
+        return image_id in self.id_to_row
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, image_id):
+        """Returns (points, descriptors) of image or None"""
+        row = self.id_to_row.get(image_id)
+        if row is None:
+            return None
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.points[start:end], self.descriptors[start:end]
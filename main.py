@@ -1,15 +1,9 @@
 """Similar images finder based on visual words vocabulary"""
 
 import argparse
-import csv
-import cv2
-import logging.config
-import os
-import vse
 
 import parameters  # model parameters defined in a separate file
-from processing_images import process_all_images
-from finder import read_ground_truth, test_on_set, userprompt_finder,  setup_logging, bow_descriptor, cnn_descriptor
+from finder import initiate_engine, setup_logging, test_on_set
 
 
 if __name__ == '__main__':
@@ -27,32 +21,13 @@ if __name__ == '__main__':
         "ground_truth",
         help="File with relationships for objects from query directory and results directory in csv format")
     parser.add_argument(
-        "voc_file",
-        help="Directory for vocabulary file in yml format")
+        "voc_file", nargs='?',
+        help="Vocabulary file in yml format for bovw model, processed/vocabulary.yml of results directory by default")
     args = parser.parse_args()
 
-    # Read the ground truth data file indicating object to scene relations.
-    ground_truth = read_ground_truth(args.ground_truth)
-
-    # Load the vocabulary from disc (should be created with
-    # create_visual_vocabulary.py)
-    vocabulary = vse.load(args.voc_file)
-
-    # Initialize features extractor (SIFT) and features matcher (Brute Force)
-    EXTRACTOR = cv2.xfeatures2d.SIFT_create(
-        nfeatures=parameters.FEATURES_CLUSTERS,
-        contrastThreshold=parameters.CONTRAST_THRES,
-        edgeThreshold=parameters.EDGE_THRES)
-    MATCHER = cv2.BFMatcher()
-
-    # Create visual search engine based on visual words vocabulary and set of
-    # your query images
-    vse_engine = cnn_descriptor(
-        args.results_directory,
-        vocabulary,
-        EXTRACTOR,
-        MATCHER,
-        parameters.FEATURES_CLUSTERS)
+    # Create visual search engine of the results directory for the feature model in parameters,
+    # bovw engine uses the vocabulary created with create_visual_vocabulary.py
+    vse_engine = initiate_engine(args.results_directory, parameters.FEATURE_MODEL, args.voc_file)
 
     # For all images in the directory find user defined number of closest matches and check
     # if they were identified correctly by comparing to ground truth.
@@ -62,6 +37,3 @@ if __name__ == '__main__':
         vse_engine,
         args.ground_truth)
 
-    # User prompt for a specific file to be searched
-    # userprompt_finder(args.results_directory,
-    #                   args.query_directory, vocabulary, args.ground_truth)
@@ -22,10 +22,80 @@ MIN_DIST = 0.7
 YOLO_THRES = 0.2
 # YOLO_THRES = 0.01
 YOLO = True #only for accuracy calculations
+YOLO_NMS = 0.3
+#Cache of detections keyed by image content hash
+DETECTIONS_DB = 'pickles/detections.sqlite'
 
 ALLOWED_CLASSES = ['diningtable', 'chair', 'sofa', 'pottedplant', 'table', 'clock', 'bed', 'plant_pot']
 ACCURACY_CLASSES = ['diningtable', 'chair', 'sofa', 'pottedplant']#use diningtable, pottedplant
 
+#Index for CNN features in [exact, ivf] and its scoring in [intersection, cosine, l2]
+DENSE_INDEX = 'exact'
+DENSE_METRIC = 'intersection'
+#Number of k-means lists and lists scored per query for ivf index
+IVF_LISTS = 32
+IVF_PROBES = 4
+
 #Feature extraction model in [vgg16, vgg19, resnet, bovw]
 FEATURE_MODEL='resnet'
-CNN_layer = 'fc2'
\ No newline at end of file
+CNN_layer = 'fc2'
+
+#Number of uploaded images whose CNN features are kept in memory
+FEATURE_CACHE_SIZE = 1000
+#On-disk cache of CNN features of images and object crops by content hash, and its initial number of rows
+OBJECT_FEATURES_CACHE = 'pickles/image_features_' + FEATURE_MODEL
+FEATURE_CACHE_CAPACITY = 1024
+#Fusion weights of visual distance and text results ranks in blended results
+BLENDER_WEIGHTS = {'visual': 1.0, 'countvect': 0.0, 'word2vec': 0.0}
+
+#Number of images passed to CNN at once and number of image decoding workers
+CNN_BATCH_SIZE = 32
+CNN_DECODE_WORKERS = 4
+
+#Number of precomputed word2vec neighbours kept for every product
+W2V_NEIGHBOURS = 10
+
+#Number of text query results kept in memory and their time to live in seconds
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_TTL = 3600
+
+#Text search candidates in [all, boolean, bm25]: all scores every product in SVD space,
+#boolean keeps products containing every query term, bm25 keeps best BM25 matches of any term
+TEXT_CANDIDATES = 'all'
+#Number of BM25 candidates kept per query
+TEXT_CANDIDATES_LIMIT = 200
+#Rank candidates by SVD cosine similarity instead of BM25 score
+TEXT_RERANK = False
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+#Number of threads querying engines of objects detected on one image
+ENGINE_QUERY_WORKERS = 4
+#Number of threads writing crops of detected objects shown in web app
+CROP_WRITE_WORKERS = 2
+
+#Geometric verification of visual results with SIFT keypoints and RANSAC homography
+GEOM_CHECK = False
+#Number of verifying processes and time budget of verification of one query in seconds
+GEOM_WORKERS = 4
+GEOM_BUDGET = 0.5
+#Lowe's ratio test and RANSAC reprojection thresholds
+RATIO_TEST = 0.8
+RANSAC_THRES = 15
+#Descriptor matcher of geometric verification in [bf, flann, numpy]
+MATCHER = 'bf'
+#FLANN KD-trees, leaves checked per search and gallery indexes kept by every verifying process
+FLANN_TREES = 4
+FLANN_CHECKS = 32
+FLANN_INDEXES_CACHED = 256
+
+#Visual vocabulary: descriptor extracting processes, descriptors sampled per image (0 keeps all),
+#descriptors per mini-batch k-means step and steps between checkpoints
+VOCAB_WORKERS = 4
+VOCAB_SAMPLE = 0
+VOCAB_BATCH = 20000
+VOCAB_CHECKPOINT_EVERY = 5
+#Number of processes converting images before vocabulary creation
+PREPROCESS_WORKERS = 4
+#Assignment of SIFT descriptors to visual words of bovw model in [numpy, kdtree]
+BOVW_QUANTIZER = 'numpy'
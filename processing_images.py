@@ -5,13 +5,31 @@ Then keypoints and descriptors are extracted from images
 Producing Bag of Visual Words vocabulary by training the bags
 with the clustered feature descriptors.
 
+Images are processed in a process pool. A manifest in the output directory
+records size, modification time and content hash of every processed source,
+so a rerun processes only new and changed images.
+
 """
 
+import json
 import logging
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import cv2
 import vse
 
+import parameters
+from image_hashes import image_hash
+
+# manifest of processed images kept in the output directory
+MANIFEST_FILE = 'manifest.json'
+# number of processed images between progress reports and manifest saves
+PROGRESS_EVERY = 100
+
+_extractor = None
+
 
 def read_image(filename, directory):
     """Reads image from the given directory"""
@@ -36,31 +54,108 @@ def process_image(filename, directory):
         return img_conv
 
 
-def process_all_images(directory):
-    """Processes all images and saves them to new directory"""
-    print('Processing all images from the diretory: ', directory)
-    new_directory = os.path.join(directory, 'processed')
-    if not os.path.exists(new_directory):
-        os.makedirs(new_directory)
-    for filename in os.listdir(directory):
-        img = process_image(filename, directory)
-        if img is not None:
-            ndir = os.path.join(new_directory, filename)
-            cv2.imwrite(ndir, img)
+def _process_one(args):
+    """Processes one image of directory to output directory for stage, returns (filename, ok).
+    Images that cannot be converted, e.g. smaller than vse accepts, are reported and not ok"""
+    global _extractor
+    filename, directory, new_directory, stage = args
+    try:
+        image = process_image(filename, directory)
+        if image is None:
+            return filename, False
+        if stage == 'keypoints':
+            if _extractor is None:
+                from geom_check import create_extractor
+                _extractor = create_extractor(parameters.CONTRAST_THRES, parameters.EDGE_THRES)
+            key_points, _ = _extractor.detectAndCompute(image, None)
+            image = cv2.drawKeypoints(
+                image, key_points, image,
+                flags=cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+        return filename, cv2.imwrite(os.path.join(new_directory, filename), image)
+    except (vse.ImageSizeError, cv2.error, OSError, ValueError) as e:
+        print('Cannot process %s: %s' % (filename, e))
+        return filename, False
+
+
+def _load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
 
-def draw_keypoints(directory, extractor):
-    """ Draws keypoints for images in given directory and save it to new one"""
+def _save_manifest(manifest_path, manifest):
+    tmp_path = '%s.%d.tmp' % (manifest_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _outdated(filename, directory, new_directory, stage, manifest):
+    """Returns True when output of source image is missing or was made from other contents or stage.
+    Source is hashed only when its size or modification time changed since the manifest entry"""
+    entry = manifest.get(filename)
+    if entry is None or entry['stage'] != stage or not os.path.exists(os.path.join(new_directory, filename)):
+        return True
+    stat = os.stat(os.path.join(directory, filename))
+    if [stat.st_size, stat.st_mtime_ns] == [entry['size'], entry['mtime_ns']]:
+        return False
+    if image_hash(os.path.join(directory, filename)) != entry['hash']:
+        return True
+    entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+    return False
+
+
+def _process_directory(directory, stage, workers):
+    """Processes changed images of directory to its 'processed' subdirectory in a process pool.
+    Outputs of removed source images are deleted"""
     new_directory = os.path.join(directory, 'processed')
     if not os.path.exists(new_directory):
         os.makedirs(new_directory)
-    for filename in os.listdir(directory):
-        image = process_image(filename, directory)
-        if image is not None:
-            print('Drawing keypoints for: ', filename)
-            key_points, _ = extractor.detectAndCompute(image, None)
-            img3 = cv2.drawKeypoints(
-                image, key_points, image,
-                flags=cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
-            ndir = os.path.join(new_directory, filename)
-            cv2.imwrite(ndir, img3)
+    manifest_path = os.path.join(new_directory, MANIFEST_FILE)
+    manifest = _load_manifest(manifest_path)
+    filenames = sorted(f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)))
+    for filename in set(manifest) - set(filenames):
+        output = os.path.join(new_directory, filename)
+        if os.path.exists(output):
+            os.remove(output)
+        del manifest[filename]
+    todo = [f for f in filenames if _outdated(f, directory, new_directory, stage, manifest)]
+    print('%d of %d images of %s to process (%s)' % (len(todo), len(filenames), directory, stage))
+    start = time.time()
+    done = failed = 0
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            args = [(f, directory, new_directory, stage) for f in todo]
+            for filename, ok in pool.map(_process_one, args, chunksize=4):
+                if ok:
+                    source = os.path.join(directory, filename)
+                    stat = os.stat(source)
+                    manifest[filename] = {'stage': stage, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                          'hash': image_hash(source)}
+                    done += 1
+                else:
+                    manifest.pop(filename, None)
+                    failed += 1
+                if (done + failed) % PROGRESS_EVERY == 0:
+                    # an interrupted run keeps images processed so far
+                    _save_manifest(manifest_path, manifest)
+                    print('  %d/%d images, %.1f images/s' % (done + failed, len(todo),
+                                                             (done + failed) / (time.time() - start)))
+    _save_manifest(manifest_path, manifest)
+    elapsed = time.time() - start
+    print('Processed %d images (%d failed, %d unchanged) in %.2fs, %.1f images/s' %
+          (done, failed, len(filenames) - len(todo), elapsed, done / elapsed if done else 0.0))
+    return new_directory
+
+
+def process_all_images(directory, workers=parameters.PREPROCESS_WORKERS):
+    """Processes new and changed images and saves them to new directory"""
+    print('Processing all images from the diretory: ', directory)
+    return _process_directory(directory, 'convert', workers)
+
+
+def draw_keypoints(directory, workers=parameters.PREPROCESS_WORKERS):
+    """ Draws keypoints for new and changed images in given directory and save it to new one"""
+    return _process_directory(directory, 'keypoints', workers)
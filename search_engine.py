@@ -1,84 +1,224 @@
 import numpy as np
-import operator
-import re
-import string
+import os
 from pickle import load
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.decomposition import TruncatedSVD
-from scipy.spatial.distance import cosine
+import threading
 import time
 import logging
+from collections import OrderedDict
+
+import parameters
+from term_index import TermIndex
+from text_normalization import normalize, normalize_batch
+from training import normalize_rows
+
+
+class QueryCache(object):
+    """LRU cache of query results with time to live. Entries belong to a model version,
+    the cache empties itself when asked about a different version"""
+
+    def __init__(self, maxsize=parameters.QUERY_CACHE_SIZE, ttl=parameters.QUERY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def get(self, key, version):
+        """Returns cached value or None"""
+        with self.lock:
+            self._check_version(version)
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, version):
+        with self.lock:
+            self._check_version(version)
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """Returns lookup counters"""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0, 'size': len(self.entries)}
 
 
 class SearchEngine(object):
+    # number of queries scored against the catalog in one matrix product
+    QUERY_BATCH_SIZE = 512
 
-    def __init__(self, products_dict,vectorizer, word2vec=None):
+    def __init__(self, products_dict,vectorizer, word2vec=None, candidates=parameters.TEXT_CANDIDATES,
+                 rerank=parameters.TEXT_RERANK):
+        if candidates not in ('all', 'boolean', 'bm25'):
+            raise ValueError('Unknown text candidates mode %s, use one of all, boolean, bm25' % candidates)
         self.products_dict = products_dict
+        self.candidates = candidates
+        self.rerank = rerank
+        self.query_cache = QueryCache()
+        self.reload_lock = threading.Lock()
+        self.set_model(vectorizer, word2vec)
+
+    @staticmethod
+    def __artifact_stamp(model):
+        """Returns (path, modification time, size) of artifact model was loaded from, None for fitted models"""
+        artifact_path = getattr(model, 'artifact_path', None)
+        if artifact_path is None:
+            return None
+        try:
+            stat = os.stat(artifact_path)
+        except OSError:
+            return None
+        return artifact_path, stat.st_mtime_ns, stat.st_size
+
+    def set_model(self, vectorizer, word2vec=None):
+        """Switches engine to new text model, cached results of the previous one are dropped"""
+        countvect_model = vectorizer.map_items_to_vectors()
+        stamps = (self.__artifact_stamp(vectorizer), self.__artifact_stamp(word2vec))
+        # reduced catalog as one matrix of unit rows, so cosine top-k is a single product
+        item_ids = np.asarray(countvect_model['ids'])
+        term_index = TermIndex(countvect_model['counts'])
+        # queries read the model through one attribute, so a reload never mixes two models
+        self.state = (countvect_model['countvect'], countvect_model['svd'], item_ids,
+                      countvect_model['item_matrix'], term_index, word2vec)
         self.vectorizer = vectorizer
         self.word2vec = word2vec
-        countvect_model = vectorizer.map_items_to_vectors()
         self.transformed = countvect_model['transformed']
         self.countvect = countvect_model['countvect']
         self.counts = countvect_model['counts']
         self.svd = countvect_model['svd']
+        self.item_ids = item_ids
+        self.item_matrix = countvect_model['item_matrix']
+        self.term_index = term_index
+        self.artifact_stamps = stamps
+        # artifacts carry hash of their source, refitted models are always new
+        self.model_version = (getattr(vectorizer, 'catalog_hash', None) or id(vectorizer),
+                              getattr(word2vec, 'source_hash', None) or id(word2vec), stamps)
+
+    def reload_if_changed(self):
+        """Reloads text model artifacts rewritten since they were loaded, e.g. by training.py.
+        Returns True when the model was switched"""
+        vectorizer, word2vec = self.vectorizer, self.word2vec
+        stamps = (self.__artifact_stamp(vectorizer), self.__artifact_stamp(word2vec))
+        if stamps == self.artifact_stamps:
+            return False
+        with self.reload_lock:
+            if stamps == self.artifact_stamps:
+                return False
+            try:
+                if stamps[0] != self.artifact_stamps[0] and stamps[0] is not None:
+                    vectorizer = type(vectorizer)(vectorizer.artifact_path)
+                if stamps[1] != self.artifact_stamps[1] and stamps[1] is not None:
+                    word2vec = type(word2vec)(word2vec.artifact_path)
+            except (FileNotFoundError, ValueError) as e:
+                print('Text model artifact could not be reloaded, keeping current model:', e)
+                return False
+            self.set_model(vectorizer, word2vec)
+            print('Text model reloaded, query cache stats of previous model:', self.query_cache.stats())
+            return True
 
-    def __preprocess(self, text):
-        regex = " *[%s]+ *" % string.punctuation.replace("\\", "\\\\").replace("]", "\\]")
-        descs_dict = {}
-        stop_list = set('for a of the and to in view more product infromation \
-                an w very by has ikea get with as information you it on thats have \
-                price reflects selected options guarantee  brochure year read about terms'.split())
-
-        text = text.lower().split()
-        text = [word for word in text if word not in stop_list]
-        text = ' '.join(text)
-        text = re.sub(regex, " ", text)
-        return text
-    
-    def __get_key(self, closest):
-        for key, value in self.transformed.items():
-            if np.array_equal(np.array(value), closest):
-                return key
-
-    def __find_closest(self, text):
-        cosine_sim = 1.0
-        sel_elem = np.array([0])
-        new_text = self.countvect.transform([self.__preprocess(text)])
-        new_reduced = self.svd.transform(new_text)[0]
-
-        for elem in list(self.transformed.values()):
-            new_cosine = cosine(new_reduced, np.array(elem))
-            if new_cosine < cosine_sim:
-                cosine_sim = new_cosine
-                sel_elem = elem
-                item_id = self.__get_key(sel_elem)
-        
-        return (item_id, cosine_sim)
+    def stats(self):
+        """Returns query cache counters"""
+        return self.query_cache.stats()
+
+    @staticmethod
+    def __reduce_queries(state, texts):
+        countvect, svd = state[:2]
+        new_texts = countvect.transform(normalize_batch(texts))
+        return new_texts.tocsr(), normalize_rows(svd.transform(new_texts))
 
     def __find_n_closest(self, text, n):
-        new_text = self.countvect.transform([self.__preprocess(text)])
-        new_reduced = self.svd.transform(new_text)[0]
-        cosine_sim = 1.0    
-        all_elems = []
-        all_sims = []
-        items_ids = []
-    
-        for elem in list(self.transformed.values()):
-            new_cosine = cosine(new_reduced, np.array(elem))
-            all_sims.append(new_cosine)
-            all_elems.append(elem)
-        indices = np.argpartition(np.array(all_sims), n)
-        sel_sims = np.array(all_sims)[indices[:n]]
-        sel_elems = np.array(all_elems)[indices[:n]]
-
-        for vec in sel_elems:
-            item_id = self.__get_key(vec)
-            items_ids.append(item_id)
-            items_dict = dict(zip(items_ids, sel_sims))
-            items_sorted = sorted(items_dict.items(), key=operator.itemgetter(1), reverse=True)
-            items, sims = zip(*items_sorted)
-        
-        return (items, sims)
+        return self.__find_n_closest_batch([text], n)[0]
+
+    def __find_n_closest_batch(self, texts, n):
+        """Returns (items, distances) of the n closest products for every text, closest first.
+        Distances are 1 - scores of the candidates mode, see __closest_in_candidates"""
+        results = []
+        state = self.state
+        item_ids = state[2]
+        n = min(n, len(item_ids))
+        for start in range(0, len(texts), self.QUERY_BATCH_SIZE):
+            counts, queries = self.__reduce_queries(state, texts[start:start + self.QUERY_BATCH_SIZE])
+            if self.candidates == 'all':
+                indices, similarities = self.__closest_in_catalog(state, queries, n)
+            else:
+                indices, similarities = self.__closest_in_candidates(state, counts, queries, n)
+            for items, sims in zip(indices, similarities):
+                results.append((tuple(item_ids[items].tolist()), tuple((1.0 - sims).tolist())))
+        return results
+
+    @staticmethod
+    def __closest_in_catalog(state, queries, n):
+        """Returns (rows, similarities) of the n most similar products of every query in SVD space"""
+        similarities = queries.dot(state[3].T)
+        rows = np.arange(len(similarities))[:, None]
+        indices = np.argpartition(-similarities, n - 1, axis=1)[:, :n]
+        indices = indices[rows, np.argsort(-similarities[rows, indices], axis=1)]
+        return indices, similarities[rows, indices]
+
+    def __closest_in_candidates(self, state, counts, queries, n):
+        """Returns (rows, scores) of the n best products of every query among products containing
+        query terms. Candidates of the whole batch are scored in one product, queries with fewer
+        than n candidates are padded with the most similar other products of the catalog.
+        Scores are SVD cosine similarities, or BM25 scores divided by the best one when candidates
+        are ranked by BM25, padding products contain no query term and score 0 then"""
+        item_ids, item_matrix, term_index = state[2:5]
+        by_bm25 = self.candidates == 'bm25' and not self.rerank
+        candidates = []
+        for i in range(len(queries)):
+            terms = counts.indices[counts.indptr[i]:counts.indptr[i + 1]]
+            if self.candidates == 'boolean':
+                candidates.append((term_index.boolean(terms), None))
+            else:
+                candidates.append(term_index.bm25(terms, parameters.TEXT_CANDIDATES_LIMIT))
+        union = np.unique(np.concatenate([rows for rows, _ in candidates] + [np.zeros(0, dtype=np.int64)]))
+        union_similarities = queries.dot(item_matrix[union].T)
+        short = [i for i, (rows, _) in enumerate(candidates) if len(rows) < n]
+        if short:
+            # fewer than n candidates leave at most n - 1 of the 2n best catalog products out
+            fallback = dict(zip(short, zip(*self.__closest_in_catalog(
+                state, queries[short], min(2 * n, len(item_ids))))))
+        indices, similarities = [], []
+        for i, (rows, bm25_scores) in enumerate(candidates):
+            if by_bm25:
+                rows, scores = rows[:n], bm25_scores[:n]
+                if len(scores):
+                    scores = scores / scores[0]
+            else:
+                scores = union_similarities[i, np.searchsorted(union, rows)]
+                order = np.argsort(-scores, kind='mergesort')[:n]
+                rows, scores = rows[order], scores[order]
+            if len(rows) < n:
+                fallback_rows, fallback_similarities = fallback[i]
+                keep = ~np.isin(fallback_rows, rows)
+                pad_rows = fallback_rows[keep][:n - len(rows)]
+                pad_scores = fallback_similarities[keep][:n - len(rows)]
+                if by_bm25 and len(rows):
+                    pad_scores = np.zeros(len(pad_rows), dtype=scores.dtype)
+                rows, scores = np.concatenate([rows, pad_rows]), np.concatenate([scores, pad_scores])
+                if not by_bm25:
+                    order = np.argsort(-scores, kind='mergesort')
+                    rows, scores = rows[order], scores[order]
+            indices.append(rows)
+            similarities.append(scores.astype(np.float32))
+        return indices, similarities
 
     def __get_images_paths(self, items_ids):
         try:
@@ -88,15 +228,41 @@ class SearchEngine(object):
             paths = ["static/" + self.products_dict[item]['img'] for item in items_ids if self.products_dict[item]['img']]
         return paths
 
+    def __cached(self, method, text, compute):
+        self.reload_if_changed()
+        key = (method, normalize(text))
+        paths = self.query_cache.get(key, self.model_version)
+        if paths is None:
+            paths = compute(text)
+            self.query_cache.put(key, paths, self.model_version)
+        return list(paths)
+
     def process_query(self, text):
-        items_ids = self.__find_n_closest(text, 10)[0]
-        return self.__get_images_paths(items_ids)
+        return self.__cached('countvect', text, lambda query:
+                             self.__get_images_paths(self.__find_n_closest(query, 10)[0]))
 
     def process_query_w2vec(self, text):
-        try:
-            item_id = self.__find_closest(text)[0]
-            most_similar = self.word2vec.most_similar(positive = [item_id])
-            most_similar = list(list(zip(*most_similar))[0])[:10]
-        except UnboundLocalError:
-            most_similar = [k for k in list(self.products_dict.keys())[:10]]
-        return self.__get_images_paths(most_similar)
\ No newline at end of file
+        return self.__cached('word2vec', text, lambda query: self.process_queries_w2vec([query])[0])
+
+    def process_queries(self, texts, n=10):
+        """Returns a list of (items ids, similarities) for every text, best match first. Similarities
+        are SVD cosines, or BM25 scores relative to the best match for bm25 candidates without rerank"""
+        self.reload_if_changed()
+        return [(items, tuple(1.0 - d for d in distances))
+                for items, distances in self.__find_n_closest_batch(list(texts), n)]
+
+    def process_queries_w2vec(self, texts):
+        """Batch version of process_query_w2vec, returns a list of images paths for every text"""
+        self.reload_if_changed()
+        word2vec = self.state[5]
+        results = []
+        for items, distances in self.__find_n_closest_batch(list(texts), 1):
+            try:
+                if distances[0] >= 1.0:
+                    raise KeyError(items[0])
+                most_similar = word2vec.most_similar(positive = [items[0]])
+                most_similar = list(list(zip(*most_similar))[0])[:10]
+            except KeyError:
+                most_similar = [k for k in list(self.products_dict.keys())[:10]]
+            results.append(self.__get_images_paths(most_similar))
+        return results
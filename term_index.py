@@ -0,0 +1,74 @@
+"""Sparse term to products inverted index for text search
+
+Built from the products by terms count matrix of CountVectorizer. The matrix is
+converted once to CSC layout, so the postings of a term, the products that
+contain it and how many times, are a contiguous slice of the index arrays.
+Queries touch only postings of their terms instead of the whole catalog.
+
+"""
+
+import numpy as np
+
+import parameters
+
+
+class TermIndex(object):
+    """Inverted index answering Boolean and BM25 queries over term ids"""
+
+    def __init__(self, counts, k1=parameters.BM25_K1, b=parameters.BM25_B):
+        postings = counts.tocsc()
+        postings.sort_indices()
+        self.indptr = postings.indptr
+        self.indices = postings.indices
+        self.tf = postings.data.astype(np.float32)
+        self.nb_docs, self.nb_terms = counts.shape
+        self.k1 = k1
+        self.b = b
+        doc_lengths = np.asarray(counts.sum(axis=1), dtype=np.float32).ravel()
+        avg_length = doc_lengths.mean() if self.nb_docs else 1.0
+        self.length_norm = k1 * (1.0 - b + b * doc_lengths / (avg_length or 1.0))
+        doc_freq = np.diff(self.indptr).astype(np.float32)
+        self.idf = np.log(1.0 + (self.nb_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def postings(self, term):
+        """Returns (product rows, term counts) of products containing term"""
+        start, end = self.indptr[term], self.indptr[term + 1]
+        return self.indices[start:end], self.tf[start:end]
+
+    def boolean(self, terms, mode='and'):
+        """Returns sorted rows of products containing all (mode 'and') or any (mode 'or') of terms"""
+        terms = np.unique(terms)
+        if len(terms) == 0:
+            return np.zeros(0, dtype=self.indices.dtype)
+        # rarest term first keeps intersections small
+        terms = terms[np.argsort(np.diff(self.indptr)[terms])]
+        rows = self.postings(terms[0])[0]
+        for term in terms[1:]:
+            if mode == 'and':
+                if len(rows) == 0:
+                    break
+                rows = np.intersect1d(rows, self.postings(term)[0], assume_unique=True)
+            else:
+                rows = np.union1d(rows, self.postings(term)[0])
+        return rows
+
+    def bm25(self, terms, n=None):
+        """Returns (rows, scores) of products matching any of terms, best BM25 score first.
+        Only n best are returned when n is given"""
+        terms = np.unique(terms)
+        if len(terms) == 0:
+            return np.zeros(0, dtype=self.indices.dtype), np.zeros(0, dtype=np.float32)
+        rows = []
+        scores = []
+        for term in terms:
+            term_rows, tf = self.postings(term)
+            rows.append(term_rows)
+            scores.append(self.idf[term] * tf * (self.k1 + 1.0) / (tf + self.length_norm[term_rows]))
+        rows, positions = np.unique(np.concatenate(rows), return_inverse=True)
+        scores = np.bincount(positions, weights=np.concatenate(scores)).astype(np.float32)
+        if n is not None and n < len(rows):
+            best = np.argpartition(-scores, n - 1)[:n]
+            rows, scores = rows[best], scores[best]
+        # stable sort keeps catalog order between equal scores
+        order = np.argsort(-scores, kind='mergesort')
+        return rows[order], scores[order]
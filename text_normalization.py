@@ -0,0 +1,43 @@
+"""Text normalization shared by products indexing and query processing
+
+Product descriptions and user queries go through the same steps: punctuation
+is replaced by spaces, text is lowercased and words from the stop list are
+dropped. The punctuation regex and the stop list are built once at import.
+
+"""
+
+import re
+import string
+
+STOP_LIST = frozenset('for a of the and to in view more product infromation \
+    an w very by has ikea get with as information you it on thats have \
+    price reflects selected options guarantee brochure year read about terms'.split())
+
+PUNCTUATION_REGEX = re.compile(" *[%s]+ *" % re.escape(string.punctuation))
+
+DESCRIPTION_KEYS = ('desc', 'type', 'name', 'color')
+
+
+def normalize(text):
+    """Returns text without punctuation and stop words, lowercased"""
+    words = PUNCTUATION_REGEX.sub(" ", text).lower().split()
+    return ' '.join([word for word in words if word not in STOP_LIST])
+
+
+def normalize_batch(texts):
+    """Returns list of normalized texts"""
+    sub = PUNCTUATION_REGEX.sub
+    stop_list = STOP_LIST
+    return [' '.join([word for word in sub(" ", text).lower().split() if word not in stop_list])
+            for text in texts]
+
+
+def product_description(product):
+    """Returns text describing product from products dictionary"""
+    return ' '.join(product[key] for key in DESCRIPTION_KEYS)
+
+
+def normalize_products(products_dict):
+    """Returns dict of product id to normalized product description"""
+    return dict(zip(products_dict.keys(),
+                    normalize_batch(product_description(product) for product in products_dict.values())))
@@ -1,16 +1,32 @@
+import argparse
 import gensim
 import numpy as np
 import os
-import re
-import string
+import pickle
 
+from scipy.sparse import csr_matrix
 from sklearn.decomposition import TruncatedSVD
 from sklearn.feature_extraction.text import CountVectorizer
 
+import parameters
+from artifacts import file_hash, load_artifact, save_artifact
+import text_normalization
+from text_normalization import normalize_products
+
+# bump when the layout or the fitting of the text model artifact changes
+TEXT_MODEL_VERSION = 2
+
+
+def normalize_rows(matrix):
+    """Returns contiguous float32 copy of matrix with rows scaled to unit L2 norm"""
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
 class LabeledSentencesFromDictDoc2Vec(object):
-    STOP_LIST = set('for a of the and to in view more product infromation \
-                    an w very by has ikea get with as you it on thats have \
-                    price reflects selected options'.split())
+    STOP_LIST = text_normalization.STOP_LIST
     MINOR_KEYS = ['name', 'color']
     MINOR_KEYS2 = ['type', 'desc']
 
@@ -49,22 +65,7 @@ class CountVectModel(object):
         self.products_dict = products_dict
 
     def __preprocess_data(self):
-        regex = " *[%s]+ *" % string.punctuation.replace("\\", "\\\\").replace("]", "\\]")
-        descs_dict = {}
-        stop_list = set('for a of the and to in view more product infromation \
-                an w very by has ikea get with as information you it on thats have \
-                price reflects selected options guarantee  brochure year read about terms'.split())
-
-        for pr_id in list(self.products_dict.keys()):
-            desc = self.products_dict[pr_id]['desc'] + ' ' + self.products_dict[pr_id]['type'] \
-            + ' ' + self.products_dict[pr_id]['name'] + ' ' + self.products_dict[pr_id]['color']
-            desc = desc.lower().split()
-            desc = [word for word in desc if word not in stop_list]
-            desc = ' '.join(desc)
-            desc = re.sub(regex, " ", desc)
-            descs_dict[pr_id] = desc
-
-        return descs_dict
+        return normalize_products(self.products_dict)
 
     def map_items_to_vectors(self):
         desc_dict_transformed = {}
@@ -72,12 +73,152 @@ class CountVectModel(object):
         descs_dict = self.__preprocess_data()
         count_vect = CountVectorizer()
         descs_counts = count_vect.fit_transform(list(descs_dict.values()))
-        svd = TruncatedSVD(n_components=25, n_iter=5)
+        svd = TruncatedSVD(n_components=25, n_iter=5, random_state=0)
         descs_counts_reduced = svd.fit_transform(descs_counts)
         for i, key in enumerate(descs_dict.keys()):
             desc_dict_transformed[key] = descs_counts_reduced[i]
 
-        return {'transformed': desc_dict_transformed, 'counts': descs_counts, 'countvect': count_vect, 'svd': svd}
+        return {'transformed': desc_dict_transformed, 'counts': descs_counts, 'countvect': count_vect, 'svd': svd,
+                'ids': np.array(list(descs_dict.keys())), 'item_matrix': normalize_rows(descs_counts_reduced)}
+
+    def save(self, artifact_path, catalog_hash):
+        """Fits the model and writes vocabulary, SVD components and reduced items to a single artifact"""
+        model = self.map_items_to_vectors()
+        vocabulary = model['countvect'].vocabulary_
+        terms = np.array(sorted(vocabulary, key=vocabulary.__getitem__))
+        counts = model['counts'].tocsr()
+        arrays = {
+            'ids': model['ids'],
+            'terms': terms,
+            'components': model['svd'].components_.astype(np.float32),
+            'reduced': np.array(list(model['transformed'].values()), dtype=np.float32),
+            'item_matrix': model['item_matrix'],
+            'counts_data': counts.data,
+            'counts_indices': counts.indices,
+            'counts_indptr': counts.indptr,
+        }
+        metadata = {'version': TEXT_MODEL_VERSION, 'catalog_hash': catalog_hash,
+                    'counts_shape': list(counts.shape)}
+        save_artifact(artifact_path, arrays, metadata)
+
+
+class SVDProjection(object):
+    """Projection on fitted TruncatedSVD components, without refitting"""
+
+    def __init__(self, components):
+        self.components_ = components
+
+    def transform(self, X):
+        return np.asarray(X.dot(self.components_.T))
+
+
+class TextModelArtifact(object):
+    """CountVectModel restored from artifact written by CountVectModel.save, arrays are memory-mapped"""
+
+    def __init__(self, artifact_path):
+        self.artifact_path = artifact_path
+        self.metadata, self.arrays = load_artifact(artifact_path)
+        self.version = self.metadata.get('version')
+        self.catalog_hash = self.metadata.get('catalog_hash')
+
+    def map_items_to_vectors(self):
+        ids = self.arrays['ids']
+        terms = self.arrays['terms'].tolist()
+        count_vect = CountVectorizer(vocabulary=dict(zip(terms, range(len(terms)))))
+        counts = csr_matrix((self.arrays['counts_data'], self.arrays['counts_indices'],
+                             self.arrays['counts_indptr']), shape=tuple(self.metadata['counts_shape']))
+        reduced = self.arrays['reduced']
+        desc_dict_transformed = {key: reduced[i] for i, key in enumerate(ids.tolist())}
+
+        return {'transformed': desc_dict_transformed, 'counts': counts, 'countvect': count_vect,
+                'svd': SVDProjection(self.arrays['components']), 'ids': ids,
+                'item_matrix': self.arrays['item_matrix']}
+
+
+def load_text_model(products_dict_path, artifact_path):
+    """Returns text model stored in artifact_path.
+    The artifact is rebuilt only when the hash of products_dict_path or the model version changes"""
+    catalog_hash = file_hash(products_dict_path)
+    try:
+        text_model = TextModelArtifact(artifact_path)
+        if text_model.catalog_hash == catalog_hash and text_model.version == TEXT_MODEL_VERSION:
+            print('Text model loaded from', artifact_path)
+            return text_model
+        print('Text model in', artifact_path, 'is out of date, rebuilding')
+    except (FileNotFoundError, ValueError):
+        print('No text model found in', artifact_path + ', building')
+    with open(products_dict_path, 'rb') as handle:
+        products_dict = pickle.load(handle)
+    CountVectModel(products_dict).save(artifact_path, catalog_hash)
+    return TextModelArtifact(artifact_path)
+
+
+def build_w2vec_neighbours(word2vec, item_ids, artifact_path, source_hash, k=parameters.W2V_NEIGHBOURS,
+                           chunk_size=1024):
+    """Computes k most similar vocabulary words for every item id in word2vec vocabulary in one
+    batched pass and stores them as int32 word indices and float16 similarities"""
+    wv = getattr(word2vec, 'wv', word2vec)
+    words = list(wv.index2word if hasattr(wv, 'index2word') else wv.index_to_key)
+    vectors = normalize_rows(wv.syn0 if hasattr(wv, 'syn0') else wv.vectors)
+    word_to_index = {word: i for i, word in enumerate(words)}
+    items = [item for item in item_ids if item in word_to_index]
+    item_rows = np.array([word_to_index[item] for item in items], dtype=np.int64)
+    k = min(k, len(words) - 1)
+    indices = np.zeros((len(items), k), dtype=np.int32)
+    scores = np.zeros((len(items), k), dtype=np.float16)
+    for start in range(0, len(items), chunk_size):
+        rows = item_rows[start:start + chunk_size]
+        similarities = vectors[rows].dot(vectors.T)
+        # an item is not its own neighbour, as in gensim most_similar
+        similarities[np.arange(len(rows)), rows] = -np.inf
+        best = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        chunk_rows = np.arange(len(rows))[:, None]
+        best = best[chunk_rows, np.argsort(-similarities[chunk_rows, best], axis=1)]
+        indices[start:start + len(rows)] = best
+        scores[start:start + len(rows)] = similarities[chunk_rows, best]
+    arrays = {'words': np.array(words), 'items': np.array(items), 'indices': indices, 'scores': scores}
+    save_artifact(artifact_path, arrays, {'version': TEXT_MODEL_VERSION, 'source_hash': source_hash})
+
+
+class Word2VecNeighbours(object):
+    """Precomputed word2vec neighbours of product ids, answers most_similar with a table lookup"""
+
+    def __init__(self, artifact_path):
+        self.artifact_path = artifact_path
+        self.metadata, arrays = load_artifact(artifact_path)
+        self.version = self.metadata.get('version')
+        self.source_hash = self.metadata.get('source_hash')
+        self.words = arrays['words'].tolist()
+        self.item_to_row = {item: row for row, item in enumerate(arrays['items'].tolist())}
+        self.indices = arrays['indices']
+        self.scores = arrays['scores']
+
+    def most_similar(self, positive, topn=10):
+        """Returns (word, similarity) list for a single positive item, same as gensim most_similar"""
+        row = self.item_to_row[positive[0]]
+        return [(self.words[i], float(score))
+                for i, score in zip(self.indices[row][:topn], self.scores[row][:topn])]
+
+
+def load_w2vec_neighbours(word2vec_path, products_dict_path, artifact_path):
+    """Returns word2vec neighbours table stored in artifact_path.
+    The table is rebuilt only when word2vec model or products dict change"""
+    source_hash = file_hash(word2vec_path) + file_hash(products_dict_path)
+    try:
+        neighbours = Word2VecNeighbours(artifact_path)
+        if neighbours.source_hash == source_hash and neighbours.version == TEXT_MODEL_VERSION:
+            print('Word2vec neighbours loaded from', artifact_path)
+            return neighbours
+        print('Word2vec neighbours in', artifact_path, 'are out of date, rebuilding')
+    except (FileNotFoundError, ValueError):
+        print('No word2vec neighbours found in', artifact_path + ', building')
+    with open(word2vec_path, 'rb') as handle:
+        word2vec = pickle.load(handle)
+    with open(products_dict_path, 'rb') as handle:
+        products_dict = pickle.load(handle)
+    build_w2vec_neighbours(word2vec, list(products_dict.keys()), artifact_path, source_hash)
+    return Word2VecNeighbours(artifact_path)
+
 
 class MyModel(object):
 
@@ -124,4 +265,22 @@ class MyModel(object):
                     vectors.append(vec)
 
             return {'vectors': np.array(vectors),
-                    'labels': np.array(labels), 'items': np.array(items)}
\ No newline at end of file
+                    'labels': np.array(labels), 'items': np.array(items)}
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'products_dict',
+        help="Pickled products dictionary the text model is fitted on")
+    parser.add_argument(
+        'artifact',
+        help="Path of the text model artifact to be written")
+    parser.add_argument('--word2vec', help="Pickled word2vec model to precompute neighbours for")
+    parser.add_argument('--neighbours', help="Path of the word2vec neighbours artifact to be written")
+    args = parser.parse_args()
+    # Fit CountVectorizer and SVD once and store them for the web app
+    load_text_model(args.products_dict, args.artifact)
+    if args.word2vec and args.neighbours:
+        load_w2vec_neighbours(args.word2vec, args.products_dict, args.neighbours)